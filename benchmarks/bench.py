@@ -0,0 +1,152 @@
+import time
+import asyncio
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Dict, List
+
+from home_led_matrix.metrics import Metrics
+from home_led_matrix.utils import HttpClient
+from home_led_matrix.display.display_handler import DisplayHandler
+from home_led_matrix.apps.snake_app.stream_handler import StreamHandler, decode_pixel_changes
+from home_led_matrix.apps.snake_app.snake_app import SnakeApp
+
+from snake_proto_template.python.sim_msgs_pb2 import MsgWrapper, StepPixelChanges
+
+from benchmarks.synthetic import SyntheticRun
+from benchmarks.fake_server import FakeSnakeServer
+
+log = logging.getLogger(Path(__file__).stem)
+
+metrics = Metrics()
+
+
+def latency_summary(seconds: List[float]) -> Dict[str, float]:
+    """ Percentiles of a list of durations, in microseconds """
+    if not seconds:
+        return {}
+    us = np.asarray(seconds) * 1e6
+    p50, p90, p99 = np.percentile(us, (50, 90, 99))
+    return {"p50_us": round(float(p50), 2), "p90_us": round(float(p90), 2), "p99_us": round(float(p99), 2), "max_us": round(float(us.max()), 2)}
+
+
+def _decoded_sub_frames(run: SyntheticRun) -> List[np.ndarray]:
+    sub_frames = []
+    for data in run.steps:
+        msg = MsgWrapper()
+        msg.ParseFromString(data)
+        step = StepPixelChanges()
+        step.ParseFromString(msg.payload)
+        sub_frames.extend(decode_pixel_changes(step))
+    return sub_frames
+
+
+def bench_decode(run: SyntheticRun) -> dict:
+    """ StreamHandler.process_message and handing the step out again, no network """
+    stream_handler = StreamHandler()
+    latencies = []
+    start = time.perf_counter()
+    for data in run.steps:
+        t0 = time.perf_counter()
+        stream_handler.process_message(data)
+        stream_handler.get_next_step_pixel_change()
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    return {"steps": len(run.steps), "steps_per_s": round(len(run.steps) / elapsed, 1), "step_latency": latency_summary(latencies)}
+
+
+def bench_display(run: SyntheticRun, overlay: bool = False) -> dict:
+    """ Scatter writing the sub-frames of the run to the DisplayHandler and pushing them to the (stub) matrix """
+    sub_frames = _decoded_sub_frames(run)
+    display_handler = DisplayHandler()
+    display_handler.set_frame(np.zeros((display_handler.height, display_handler.width, 3), dtype=np.uint8))
+    display_handler.invalidate()
+    display_handler.show()
+    if overlay:
+        layer = display_handler.add_layer("bench", z=1)
+        layer.draw(np.full((8, 24, 3), 255, dtype=np.uint8), 2, 2, alpha=160)
+    latencies = []
+    start = time.perf_counter()
+    try:
+        for pixels in sub_frames:
+            t0 = time.perf_counter()
+            display_handler.set_pixels(pixels["x"], pixels["y"], pixels["color"])
+            display_handler.show()
+            latencies.append(time.perf_counter() - t0)
+    finally:
+        if overlay:
+            display_handler.remove_layer("bench")
+    elapsed = time.perf_counter() - start
+    return {"frames": len(sub_frames), "frames_per_s": round(len(sub_frames) / elapsed, 1), "frame_latency": latency_summary(latencies)}
+
+
+async def bench_stream(run: SyntheticRun, latency: float = 0.0) -> dict:
+    """ StreamHandler against the fake server over a local websocket, steps are taken as fast as they arrive """
+    async with FakeSnakeServer(lambda: run, latency=latency) as server:
+        stream_handler = StreamHandler()
+        start = time.perf_counter()
+        await stream_handler.start_stream("bench", "127.0.0.1", server.port)
+        first_step_at = None
+        received = 0
+        try:
+            while received < len(run.steps):
+                step = stream_handler.get_next_step_pixel_change()
+                if step is None:
+                    await asyncio.sleep(0)
+                    continue
+                if first_step_at is None:
+                    first_step_at = time.perf_counter()
+                received += 1
+        finally:
+            await stream_handler.stop()
+        elapsed = time.perf_counter() - start
+        return {
+            "steps": received,
+            "steps_per_s": round(received / elapsed, 1),
+            "first_step_ms": round((first_step_at - start) * 1000, 2),
+            "server_requests": server.requests,
+        }
+
+
+async def bench_snake_app(run: SyntheticRun, fps: float = 1000, latency: float = 0.0) -> dict:
+    """ The whole SnakeApp against the fake server: request_run, stream, map and every sub-frame pushed to the matrix.
+    Pre-warming is off, so only one run is streamed at a time """
+    async with FakeSnakeServer(lambda: run, latency=latency) as server:
+        app = SnakeApp("127.0.0.1", server.port)
+        app._config.set("prewarm_seconds", 0)
+        await app.set_fps(fps)
+        await metrics.reset()
+        start = time.perf_counter()
+        task = asyncio.create_task(app.run())
+        first_frame_at = None
+        try:
+            while True:
+                summary = metrics.summary().get("snake.update_display_ms", {"count": 0})
+                if first_frame_at is None and summary["count"] > 0:
+                    first_frame_at = time.perf_counter()
+                if summary["count"] >= run.sub_frame_count:
+                    break
+                if task.done():
+                    raise RuntimeError("The snake app stopped before the run was displayed")
+                await asyncio.sleep(0.005)
+            elapsed = time.perf_counter() - start
+        finally:
+            await app.stop()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await HttpClient().close()
+        summary = metrics.summary()
+        return {
+            "steps": len(run.steps),
+            "steps_per_s": round(len(run.steps) / (elapsed - (first_frame_at - start)), 1),
+            "frames_per_s": round(run.sub_frame_count / (elapsed - (first_frame_at - start)), 1),
+            "target_fps": fps,
+            "first_frame_ms": round((first_frame_at - start) * 1000, 2),
+            "frame_stats": app._frame_clock.get_stats(),
+            "metrics": {
+                name: summary[name] for name in (
+                    "snake.lateness_ms", "snake.update_display_ms", "snake.buffer_depth",
+                    "display.push_ms", "stream.pixel_decode_ms", "stream.pixel_changes_ms",
+                ) if name in summary
+            },
+        }
@@ -0,0 +1,91 @@
+import asyncio
+import itertools
+import logging
+from pathlib import Path
+from typing import Callable, Optional
+
+from aiohttp import web, WSMsgType
+
+from snake_proto_template.python.sim_msgs_pb2 import (
+    Request,
+    RequestType,
+    PixelChangesReq,
+)
+
+from benchmarks.synthetic import SyntheticRun
+
+log = logging.getLogger(Path(__file__).stem)
+
+
+class FakeSnakeServer:
+    """ Stands in for the snake server: the request_run and map_names endpoints and the watch websocket.
+    Every requested run is served from make_run(). latency is added before each reply, to simulate the network """
+
+    def __init__(self, make_run: Callable[[], SyntheticRun], host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self._make_run = make_run
+        self._host = host
+        self._port = port
+        self._latency = latency
+        self._run_ids = itertools.count()
+        self._runner: Optional[web.AppRunner] = None
+        self.requests = 0
+        self.steps_sent = 0
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    async def start(self):
+        app = web.Application()
+        app.add_routes([
+            web.post("/api/request_run", self._request_run),
+            web.get("/api/map_names", self._map_names),
+            web.get("/ws/watch/{run_id}", self._watch),
+        ])
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        # port 0 picks a free port
+        self._port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _request_run(self, request: web.Request):
+        await request.read()
+        return web.json_response({"result": "success", "run_id": f"bench-{next(self._run_ids)}"})
+
+    async def _map_names(self, request: web.Request):
+        return web.json_response([])
+
+    async def _watch(self, request: web.Request):
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        run = self._make_run()
+        async for message in ws:
+            if message.type != WSMsgType.BINARY:
+                continue
+            self.requests += 1
+            req = Request()
+            req.ParseFromString(message.data)
+            if self._latency:
+                await asyncio.sleep(self._latency)
+            if req.type == RequestType.RUN_META_DATA_REQ:
+                await ws.send_bytes(run.meta_data_message())
+                await ws.send_bytes(run.run_update_message())
+            elif req.type == RequestType.PIXEL_CHANGES_REQ:
+                pixel_req = PixelChangesReq()
+                pixel_req.ParseFromString(req.payload)
+                for step in range(pixel_req.start_step, min(pixel_req.end_step, run.final_step) + 1):
+                    await ws.send_bytes(run.steps[step])
+                    self.steps_sent += 1
+        return ws
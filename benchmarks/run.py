@@ -0,0 +1,190 @@
+""" Offline benchmarks of the display and streaming hot paths, runs on any Linux box with the rgbmatrix stub.
+
+    python -m benchmarks.run                     run everything, results go to benchmarks/results/
+    python -m benchmarks.run --only decode,display --steps 5000
+    python -m benchmarks.run --recorded ~/.cache/home_led_matrix/runs/<run_id>
+    python -m benchmarks.run --compare benchmarks/results/<old>.json
+
+Every benchmark runs in its own process, so peak RSS is per benchmark. Each one is run twice, once for timing and
+once under tracemalloc for the allocations, which would skew the timings otherwise. The inputs are seeded, so results
+with the same parameters are comparable across commits. """
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+from pathlib import Path
+
+BENCHMARKS = ("decode", "display", "display_overlay", "stream", "snake_app")
+RESULTS_DIR = Path(__file__).parent / "results"
+REPO_DIR = Path(__file__).parent.parent
+
+
+def cli(args):
+    p = argparse.ArgumentParser(description="Home LED Matrix benchmarks")
+    p.add_argument("--only", default=",".join(BENCHMARKS), help=f"Comma separated benchmarks, default: all of {','.join(BENCHMARKS)}")
+    p.add_argument("--steps", type=int, default=2000, help="Steps of the synthetic run, default: 2000")
+    p.add_argument("--snakes", type=int, default=7, help="Snakes in the synthetic run, default: 7")
+    p.add_argument("--seed", type=int, default=0, help="Seed of the synthetic run, default: 0")
+    p.add_argument("--recorded", default=None, help="Replay a run from the run cache instead of a synthetic one")
+    p.add_argument("--latency", type=float, default=0.0, help="Seconds the fake server waits before each reply, default: 0")
+    p.add_argument("--fps", type=float, default=1000, help="Target fps of the snake app benchmark, default: 1000")
+    p.add_argument("--out", default=str(RESULTS_DIR), help=f"Results directory, default: {RESULTS_DIR}")
+    p.add_argument("--compare", default=None, help="Compare with an earlier results file")
+    p.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    return p.parse_args(args)
+
+
+def git_info() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(status) if status is not None else None}
+
+
+def environment() -> dict:
+    import numpy as np
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def make_run(args):
+    from benchmarks.synthetic import synthetic_run, recorded_run
+    if args.recorded:
+        return recorded_run(Path(args.recorded).expanduser())
+    return synthetic_run(steps=args.steps, snakes=args.snakes, seed=args.seed)
+
+
+def run_benchmark(name: str, run, args) -> dict:
+    from benchmarks import bench
+    if name == "decode":
+        return bench.bench_decode(run)
+    if name == "display":
+        return bench.bench_display(run)
+    if name == "display_overlay":
+        return bench.bench_display(run, overlay=True)
+    if name == "stream":
+        return asyncio.run(bench.bench_stream(run, latency=args.latency))
+    if name == "snake_app":
+        return asyncio.run(bench.bench_snake_app(run, fps=args.fps, latency=args.latency))
+    raise ValueError(f"Unknown benchmark: {name}")
+
+
+def child(name: str, args):
+    """ Runs one benchmark in this process and prints its result as json """
+    run = make_run(args)
+    result = run_benchmark(name, run, args)
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    tracemalloc.start()
+    run_benchmark(name, run, args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result["alloc_peak_kb"] = round(peak / 1024, 1)
+    result["alloc_retained_kb"] = round(current / 1024, 1)
+    print(json.dumps(result))
+
+
+def spawn(name: str, argv) -> dict:
+    # the app config is persisted in the home directory, keep the benchmarks away from the real one
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, PYTHONPATH=os.pathsep.join(filter(None, [str(REPO_DIR), os.environ.get("PYTHONPATH")])))
+        proc = subprocess.run([sys.executable, "-m", "benchmarks.run", *argv, "--child", name], cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit code {proc.returncode}"}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def _flatten(result: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(old: dict, new: dict):
+    print(f"\n{old.get('commit', '?')[:10]} -> {new.get('commit', '?')[:10]}")
+    if old.get("params") != new.get("params"):
+        print("warning: the runs used different parameters, the numbers are not comparable")
+    for name, new_result in new["results"].items():
+        old_result = old["results"].get(name)
+        if old_result is None:
+            continue
+        old_flat, new_flat = _flatten(old_result), _flatten(new_result)
+        print(f"\n{name}")
+        for key, new_value in new_flat.items():
+            old_value = old_flat.get(key)
+            if old_value is None:
+                continue
+            ratio = f"{new_value / old_value:.2f}x" if old_value else "-"
+            print(f"  {key:40} {old_value:>12} {new_value:>12} {ratio:>8}")
+
+
+def main(argv):
+    args = cli(argv)
+    logging.basicConfig(level=logging.WARNING)
+    if args.child:
+        child(args.child, args)
+        return
+    names = [name.strip() for name in args.only.split(",") if name.strip()]
+    for name in names:
+        if name not in BENCHMARKS:
+            raise SystemExit(f"Unknown benchmark: {name}, must be one of {BENCHMARKS}")
+    # pass the parameters on to the children, without the ones that only concern this process
+    child_argv = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ("--only", "--out", "--compare"):
+            skip = True
+        elif not arg.startswith(("--only=", "--out=", "--compare=")):
+            child_argv.append(arg)
+    results = {}
+    for name in names:
+        print(f"running {name}...", file=sys.stderr)
+        results[name] = spawn(name, child_argv)
+    report = {
+        **git_info(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {
+            "steps": args.steps,
+            "snakes": args.snakes,
+            "seed": args.seed,
+            "recorded": args.recorded,
+            "latency": args.latency,
+            "fps": args.fps,
+        },
+        "environment": environment(),
+        "results": results,
+    }
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_file = out_dir / f"{time.strftime('%Y%m%d-%H%M%S')}-{(report['commit'] or 'unknown')[:10]}.json"
+    out_file.write_text(json.dumps(report, indent=2))
+    print(json.dumps(results, indent=2))
+    print(f"results written to {out_file}", file=sys.stderr)
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), report)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+import numpy as np
+from pathlib import Path
+from typing import List
+
+from snake_proto_template.python.sim_msgs_pb2 import (
+    MsgWrapper,
+    MessageType,
+    RunMetaData,
+    RunUpdate,
+    StepPixelChanges,
+)
+
+from home_led_matrix.apps.snake_app.run_cache import CachedRun
+
+# The snake server runs on a 32x32 grid which is shown 2x on the 64x64 panel
+GRID_SIZE = 32
+FREE_VALUE = 0
+BLOCKED_VALUE = 1
+
+
+class SyntheticRun:
+    """ A run as the snake server would stream it, every message is serialized up front so serving it costs nothing """
+
+    def __init__(self, meta_data: RunMetaData, steps: List[bytes], sub_frame_count: int):
+        self.meta_data = meta_data
+        self.steps = steps
+        self.sub_frame_count = sub_frame_count
+
+    @property
+    def final_step(self) -> int:
+        return len(self.steps) - 1
+
+    def meta_data_message(self) -> bytes:
+        return MsgWrapper(type=MessageType.RUN_META_DATA, payload=self.meta_data.SerializeToString()).SerializeToString()
+
+    def run_update_message(self) -> bytes:
+        return MsgWrapper(type=MessageType.RUN_UPDATE, payload=RunUpdate(final_step=self.final_step).SerializeToString()).SerializeToString()
+
+
+def _meta_data(base_map: np.ndarray) -> RunMetaData:
+    meta_data = RunMetaData()
+    meta_data.width = base_map.shape[1]
+    meta_data.height = base_map.shape[0]
+    meta_data.base_map = base_map.tobytes()
+    meta_data.base_map_dtype = str(base_map.dtype)
+    meta_data.blocked_value = BLOCKED_VALUE
+    for value, (r, g, b) in ((FREE_VALUE, (0, 0, 0)), (BLOCKED_VALUE, (80, 80, 80))):
+        color = meta_data.color_mapping[value]
+        color.r, color.g, color.b = r, g, b
+    return meta_data
+
+
+def _step_message(step: int, sub_frames: List[List[tuple]]) -> bytes:
+    step_changes = StepPixelChanges(step=step)
+    for sub_frame in sub_frames:
+        change = step_changes.changes.add()
+        for x, y, (r, g, b) in sub_frame:
+            pixel = change.pixels.add()
+            pixel.coord.x, pixel.coord.y = x, y
+            pixel.color.r, pixel.color.g, pixel.color.b = r, g, b
+    return MsgWrapper(type=MessageType.PIXEL_CHANGES, payload=step_changes.SerializeToString()).SerializeToString()
+
+
+def synthetic_run(steps: int = 2000, snakes: int = 7, length: int = 12, seed: int = 0) -> SyntheticRun:
+    """ Snakes wandering at random over an empty map with a wall around it. Each step has two sub-frames,
+    like the server sends them: the half step between two cells and the new head, with the tail cleared """
+    rng = np.random.default_rng(seed)
+    base_map = np.full((GRID_SIZE, GRID_SIZE), FREE_VALUE, dtype=np.uint8)
+    base_map[[0, -1], :] = BLOCKED_VALUE
+    base_map[:, [0, -1]] = BLOCKED_VALUE
+    moves = np.array([(1, 0), (-1, 0), (0, 1), (0, -1)])
+    colors = [tuple(int(c) for c in rng.integers(64, 256, 3)) for _ in range(snakes)]
+    bodies = [[tuple(int(c) for c in rng.integers(1, GRID_SIZE - 1, 2))] for _ in range(snakes)]
+    messages = []
+    for step in range(steps):
+        half_step, full_step = [], []
+        for body, color in zip(bodies, colors):
+            x, y = body[-1]
+            dx, dy = moves[rng.integers(len(moves))]
+            nx, ny = int(np.clip(x + dx, 1, GRID_SIZE - 2)), int(np.clip(y + dy, 1, GRID_SIZE - 2))
+            half_step.append((x + nx, y + ny, color))
+            full_step.append((nx * 2, ny * 2, color))
+            body.append((nx, ny))
+            if len(body) > length:
+                tx, ty = body.pop(0)
+                nx2, ny2 = body[0]
+                full_step.append((tx * 2, ty * 2, (0, 0, 0)))
+                full_step.append((tx + nx2, ty + ny2, (0, 0, 0)))
+        messages.append(_step_message(step, [half_step, full_step]))
+    return SyntheticRun(_meta_data(base_map), messages, sub_frame_count=2 * steps)
+
+
+def recorded_run(path: Path) -> SyntheticRun:
+    """ Serves a run from the snake app's run cache, see RunCache """
+    run = CachedRun(Path(path))
+    messages = []
+    sub_frame_count = 0
+    for step in range(run.step_count):
+        sub_frames = [
+            [(int(p["x"]), int(p["y"]), tuple(int(c) for c in p["color"])) for p in sub_frame]
+            for sub_frame in run.get_step(step).pixel_data
+        ]
+        sub_frame_count += len(sub_frames)
+        messages.append(_step_message(step, sub_frames))
+    return SyntheticRun(run.init_data, messages, sub_frame_count)
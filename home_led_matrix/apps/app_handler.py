@@ -5,6 +5,7 @@ from typing import List, Dict, Optional
 
 from home_led_matrix.display.display_handler import DisplayHandler
 from home_led_matrix.apps.app_interface import IAsyncApp
+from home_led_matrix.apps.transitions import TransitionEngine
 from home_led_matrix.apps.snake_app.snake_app import SnakeApp
 from home_led_matrix.apps.pixelart_app.pixelart_app import PixelArtApp
 
@@ -17,10 +18,20 @@ class MissingAppError(Exception):
 
 
 class AppHandler:
-    def __init__(self):
+    """ Runs one app on the display at a time.
+
+    Apps that are switched away from are suspended, not stopped, and resumed when they are switched to again.
+    The next app is prepared while the current one keeps drawing, and takes over on a frame boundary,
+    so the panel shows the old app until the new one has its first frame. """
+
+    def __init__(self, prepare_timeout: float = 15, frame_timeout: float = 0.5):
         self._apps: Dict[str, IAsyncApp] = {}
-        self._current_app_task: Optional[asyncio.Task] = None
+        self._app_tasks: Dict[str, asyncio.Task] = {}
         self._current_app_name: Optional[str] = None
+        self._pending_app_name: Optional[str] = None
+        self._switch_task: Optional[asyncio.Task] = None
+        self._prepare_timeout = prepare_timeout
+        self._frame_timeout = frame_timeout
 
     def add_app(self, app_name, app: IAsyncApp):
         if not isinstance(app, IAsyncApp):
@@ -34,25 +45,66 @@ class AppHandler:
                 return app
         return None
 
-    async def _stop_current_app(self):
-        if app := self._get_current_app():
-            await app.stop()
-            if self._current_app_task is not None:
-                self._current_app_task.cancel()
-                try:
-                    await self._current_app_task
-                except asyncio.CancelledError:
-                    pass
-            self._current_app_task = None
+    async def _stop_app(self, app_name):
+        app = self._apps[app_name]
+        await app.stop()
+        task = self._app_tasks.pop(app_name, None)
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if app_name == self._current_app_name:
             self._current_app_name = None
 
     async def switch_app(self, app_name):
-        next_app = self._apps.get(app_name)
-        if next_app is None:
+        """ Starts switching to the app and returns, the switch is done in the background """
+        if app_name not in self._apps:
             raise MissingAppError(f"App {app_name} not found")
-        await self._stop_current_app()
+        if self._switch_task is not None and not self._switch_task.done():
+            if app_name == self._pending_app_name:
+                return
+            self._switch_task.cancel()
+        if app_name == self._current_app_name:
+            self._pending_app_name = None
+            return
+        self._pending_app_name = app_name
+        self._switch_task = asyncio.create_task(self._switch(app_name))
+
+    async def wait_switched(self):
+        if self._switch_task is not None:
+            try:
+                await self._switch_task
+            except asyncio.CancelledError:
+                pass
+
+    async def _switch(self, app_name):
+        next_app = self._apps[app_name]
+        try:
+            # the prepared state is picked up by run() or resume() even if it is not ready in time
+            await asyncio.wait_for(asyncio.shield(next_app.prepare()), self._prepare_timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"Preparing {app_name} took more than {self._prepare_timeout}s, switching anyway")
+        except Exception as e:
+            log.error(f"Preparing {app_name} failed: {e}")
+        if current_app := self._get_current_app():
+            # don't cut the current app off in the middle of drawing a frame
+            await display_handler.wait_frame(self._frame_timeout)
+            await current_app.suspend()
+            # created on first use, the engine loads and saves its config
+            TransitionEngine().begin()
+        # from here on the suspended app can't draw over the next one, even if it is in the middle of something
+        display_handler.set_owner(next_app)
         self._current_app_name = app_name
-        self._current_app_task = asyncio.create_task(next_app.run())
+        self._pending_app_name = None
+        task = self._app_tasks.get(app_name)
+        if task is not None and not task.done():
+            await next_app.resume()
+            await next_app.redraw()
+        else:
+            self._app_tasks[app_name] = asyncio.create_task(next_app.run())
+        log.debug(f"Switched to {app_name}")
 
     async def pause_current_app(self):
         if app := self._get_current_app():
@@ -70,6 +122,9 @@ class AppHandler:
     async def get_brightness(self):
         return display_handler.get_brightness()
 
+    async def get_changed_pixels(self):
+        return display_handler.changed_pixels
+
     async def display_on(self, value):
         if app := self._get_current_app():
             if value:
@@ -90,4 +145,8 @@ class AppHandler:
         return self._current_app_name
 
     async def shutdown(self):
-        await self._stop_current_app()
\ No newline at end of file
+        if self._switch_task is not None:
+            self._switch_task.cancel()
+        await TransitionEngine().cancel()
+        for app_name in list(self._app_tasks):
+            await self._stop_app(app_name)
\ No newline at end of file
@@ -32,3 +32,11 @@ class IAsyncApp(ABC):
         """Return if the app is running."""
         pass
 
+    async def prepare(self):
+        """Load and buffer in the background before run() or resume(), without touching the display."""
+        pass
+
+    async def suspend(self):
+        """Pause in the background when another app takes over, leaving the display as it is."""
+        await self.pause()
+
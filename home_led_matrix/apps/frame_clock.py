@@ -0,0 +1,101 @@
+import asyncio
+import time
+import logging
+import numpy as np
+from pathlib import Path
+from collections import deque
+from typing import Optional
+
+from home_led_matrix.metrics import Metrics
+
+log = logging.getLogger(Path(__file__).stem)
+
+metrics = Metrics()
+
+# What to do when the clock falls behind schedule
+DROP = "drop"  # skip the missed frames and continue on the next deadline in the future
+CATCH_UP = "catch_up"  # run the missed frames back to back, up to max_catch_up frames, then resync
+
+POLICIES = (DROP, CATCH_UP)
+
+
+class FrameClock:
+    """ Paces frames against absolute monotonic deadlines, so the time spent drawing does not add up as drift.
+
+    Call tick() once per frame, it returns when the frame is due. """
+
+    def __init__(self, fps: float, policy: str = DROP, max_catch_up: int = 5, stats_window: int = 120, name: Optional[str] = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown frame policy: {policy}, must be one of {POLICIES}")
+        self._policy = policy
+        self._max_catch_up = max_catch_up
+        self._interval = self._get_interval(fps)
+        self._next_deadline: Optional[float] = None
+        self._last_tick: Optional[float] = None
+        self._tick_times = deque(maxlen=stats_window)
+        self._lateness = deque(maxlen=stats_window)
+        self._dropped = 0
+        # lateness is reported to the metrics as <name>.lateness_ms if the clock has a name
+        self._lateness_metric = f"{name}.lateness_ms" if name else None
+
+    @staticmethod
+    def _get_interval(fps: float) -> float:
+        if not fps > 0:
+            raise ValueError(f"fps must be greater than 0, got {fps}")
+        return 1 / fps
+
+    def set_fps(self, fps: float):
+        self._interval = self._get_interval(fps)
+
+    def get_fps(self) -> float:
+        return 1 / self._interval
+
+    def reset(self):
+        """ Start over from now, call this after the frames have been paused """
+        self._next_deadline = None
+        self._last_tick = None
+        self._tick_times.clear()
+        self._lateness.clear()
+
+    async def tick(self, interval: Optional[float] = None):
+        """ Wait until the next frame is due. interval overrides how long this frame lasts, for variable frame durations """
+        interval = self._interval if interval is None else interval
+        now = time.monotonic()
+        if self._next_deadline is None:
+            self._next_deadline = now
+        delay = self._next_deadline - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            frames_behind = int(-delay / interval) if interval > 0 else 0
+            if self._policy == DROP and frames_behind > 0:
+                self._next_deadline += frames_behind * interval
+                self._dropped += frames_behind
+            elif self._policy == CATCH_UP and frames_behind > self._max_catch_up:
+                log.debug(f"{frames_behind} frames behind, resyncing")
+                self._next_deadline = now
+                self._dropped += frames_behind
+            await asyncio.sleep(0)
+        self._last_tick = time.monotonic()
+        self._tick_times.append(self._last_tick)
+        self._lateness.append(max(0.0, self._last_tick - self._next_deadline))
+        if self._lateness_metric is not None:
+            metrics.observe(self._lateness_metric, self._lateness[-1] * 1000)
+        self._next_deadline += interval
+
+    def get_stats(self) -> dict:
+        """ Achieved fps and jitter over the last stats_window frames, times are in milliseconds """
+        stats = {
+            "target_fps": round(self.get_fps(), 2),
+            "fps": 0.0,
+            "jitter_ms": 0.0,
+            "mean_lateness_ms": 0.0,
+            "dropped": self._dropped,
+        }
+        if len(self._tick_times) > 1:
+            intervals = np.diff(np.fromiter(self._tick_times, dtype=np.float64))
+            total = float(intervals.sum())
+            stats["fps"] = round(len(intervals) / total, 2) if total > 0 else 0.0
+            stats["jitter_ms"] = round(float(intervals.std()) * 1000, 2)
+            stats["mean_lateness_ms"] = round(float(np.mean(self._lateness)) * 1000, 2)
+        return stats
@@ -0,0 +1,169 @@
+import os
+import hashlib
+import logging
+import threading
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from home_led_matrix.apps.pixelart_app.image_loader import Animation, decode_image
+
+log = logging.getLogger(Path(__file__).stem)
+
+# An atlas entry is two raw .npy files named by the hash of the cache key, the frames are memory mapped when loaded:
+#   <key>.frames.npy     (N, height, width, 3) uint8
+#   <key>.durations.npy  (N,) float64
+# durations is written first, so an entry is complete when its frames file exists
+FRAMES_SUFFIX = ".frames.npy"
+DURATIONS_SUFFIX = ".durations.npy"
+
+
+def cache_key(path: Path, size: Tuple[int, int]) -> Tuple:
+    """ Changes when the file is modified or the display size changes, so stale entries are never returned """
+    stat = os.stat(path)
+    return (str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size, tuple(size))
+
+
+class FrameCache:
+    """ Decoded animations kept in memory up to max_bytes, least recently used are evicted first.
+
+    With an atlas_dir the decoded frames are also written to disk and memory mapped from there,
+    so a restart does not have to decode every image again. Thread safe, get() is blocking, run it in an executor. """
+
+    def __init__(self, max_bytes: int, atlas_dir: Optional[Path] = None, atlas_max_bytes: int = 0):
+        self._max_bytes = max_bytes
+        self._atlas_dir = Path(atlas_dir).expanduser() if atlas_dir else None
+        self._atlas_max_bytes = atlas_max_bytes
+        self._entries: "OrderedDict[Tuple, Animation]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._atlas_hits = 0
+        self._misses = 0
+
+    def get(self, path: Path, size: Tuple[int, int]) -> Animation:
+        key = cache_key(path, size)
+        with self._lock:
+            animation = self._entries.get(key)
+            if animation is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return animation
+        animation = self._load_atlas(key)
+        with self._lock:
+            if animation is not None:
+                self._atlas_hits += 1
+            else:
+                self._misses += 1
+        if animation is None:
+            animation = decode_image(path, size)
+            animation = self._save_atlas(key, animation) or animation
+        self._put(key, animation)
+        return animation
+
+    def _put(self, key: Tuple, animation: Animation):
+        with self._lock:
+            if key in self._entries:
+                return
+            if animation.nbytes > self._max_bytes:
+                log.debug(f"Not caching {key[0]}, {animation.nbytes} bytes is over the budget")
+                return
+            self._entries[key] = animation
+            self._nbytes += animation.nbytes
+            while self._nbytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+
+    def invalidate(self, path: Optional[Path] = None):
+        """ Drops the in memory entries of path, or every entry """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self._nbytes = 0
+                return
+            resolved = str(Path(path).resolve())
+            for key in [key for key in self._entries if key[0] == resolved]:
+                self._nbytes -= self._entries.pop(key).nbytes
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._nbytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "atlas_hits": self._atlas_hits,
+                "misses": self._misses,
+            }
+
+    def _atlas_path(self, key: Tuple) -> Path:
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return self._atlas_dir / digest
+
+    def _load_atlas(self, key: Tuple) -> Optional[Animation]:
+        if self._atlas_dir is None:
+            return None
+        base = self._atlas_path(key)
+        frames_path = base.with_name(base.name + FRAMES_SUFFIX)
+        if not frames_path.exists():
+            return None
+        try:
+            animation = Animation(
+                frames=np.load(frames_path, mmap_mode="r"),
+                durations=np.load(base.with_name(base.name + DURATIONS_SUFFIX)),
+            )
+            # the mtime is the LRU timestamp of the atlas
+            os.utime(frames_path)
+            return animation
+        except (OSError, ValueError) as e:
+            log.warning(f"Broken atlas entry {frames_path.name}: {e}")
+            return None
+
+    def _save_atlas(self, key: Tuple, animation: Animation) -> Optional[Animation]:
+        """ Returns the animation memory mapped from the atlas, or None if it could not be written """
+        if self._atlas_dir is None:
+            return None
+        base = self._atlas_path(key)
+        tmp_path = base.with_name(f".{base.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            self._atlas_dir.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.save(f, animation.durations)
+            os.replace(tmp_path, base.with_name(base.name + DURATIONS_SUFFIX))
+            with open(tmp_path, "wb") as f:
+                np.save(f, animation.frames)
+            os.replace(tmp_path, base.with_name(base.name + FRAMES_SUFFIX))
+        except OSError as e:
+            log.warning(f"Could not write atlas entry for {key[0]}: {e}")
+            return None
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        self.evict_atlas()
+        return self._load_atlas(key)
+
+    def evict_atlas(self):
+        if self._atlas_dir is None or not self._atlas_dir.exists():
+            return
+        entries = []
+        total = 0
+        for frames_path in self._atlas_dir.glob("*" + FRAMES_SUFFIX):
+            durations_path = frames_path.with_name(frames_path.name[:-len(FRAMES_SUFFIX)] + DURATIONS_SUFFIX)
+            try:
+                stat = frames_path.stat()
+                size = stat.st_size + (durations_path.stat().st_size if durations_path.exists() else 0)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, size, frames_path, durations_path))
+            total += size
+        entries.sort()
+        while entries and total > self._atlas_max_bytes:
+            _, size, frames_path, durations_path = entries.pop(0)
+            log.debug(f"Evicting atlas entry {frames_path.name}")
+            for p in (frames_path, durations_path):
+                try:
+                    p.unlink()
+                except FileNotFoundError:
+                    pass
+            total -= size
@@ -0,0 +1,285 @@
+import os
+import struct
+import asyncio
+import logging
+import ctypes
+import ctypes.util
+import functools
+from pathlib import Path
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, Iterable, List, Optional
+from PIL import Image, ImageSequence
+
+from home_led_matrix.apps.pixelart_app.image_loader import IMAGE_EXTENSIONS, MIN_FRAME_DURATION, DEFAULT_FRAME_DURATION
+
+log = logging.getLogger(Path(__file__).stem)
+
+# inotify(7) constants
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+
+@dataclass
+class ImageInfo:
+    name: str
+    file_size: int
+    mtime_ns: int
+    width: int = 0
+    height: int = 0
+    frames: int = 0
+    duration: float = 0.0  # seconds for one loop of an animation, 0 for still images
+    error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        info = asdict(self)
+        del info["mtime_ns"]
+        return info
+
+
+def read_image_info(path: Path) -> ImageInfo:
+    """ Reads the header and frame timings of an image, without converting the frames. Blocking, run it in an executor """
+    stat = path.stat()
+    info = ImageInfo(name=path.name, file_size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    try:
+        with Image.open(path) as image:
+            info.width, info.height = image.size
+            info.frames = getattr(image, "n_frames", 1)
+            if getattr(image, "is_animated", False):
+                for frame in ImageSequence.Iterator(image):
+                    duration = frame.info.get("duration", 0) / 1000
+                    info.duration += duration if duration >= MIN_FRAME_DURATION else DEFAULT_FRAME_DURATION
+                info.duration = round(info.duration, 3)
+    except Exception as e:
+        info.error = str(e)
+    return info
+
+
+@functools.lru_cache(maxsize=None)
+def _load_inotify():
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class ImageIndex:
+    """ Metadata of every image in a directory, updated incrementally.
+
+    Changes are picked up through inotify where it is available, otherwise the directory is polled.
+    Only files that were added or whose size or mtime changed are read again. """
+
+    def __init__(self, image_dir: Path, poll_interval: float = 5, settle_delay: float = 0.2):
+        self._image_dir = Path(image_dir)
+        self._poll_interval = poll_interval
+        # events are collected for this long before they are handled, copying a file gives a burst of them
+        self._settle_delay = settle_delay
+        self._entries: Dict[str, ImageInfo] = {}
+        self._listeners: List[Callable[[], None]] = []
+        self._inotify_fd: Optional[int] = None
+        self._poll_task: Optional[asyncio.Task] = None
+        self._update_task: Optional[asyncio.Task] = None
+        self._pending: set = set()
+        self._full_rescan = False
+        self._settle_handle: Optional[asyncio.TimerHandle] = None
+        self._started = False
+        self._start_lock = asyncio.Lock()
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        """ Incremented on every change of the index """
+        return self._version
+
+    def add_listener(self, listener: Callable[[], None]):
+        self._listeners.append(listener)
+
+    async def start(self):
+        async with self._start_lock:
+            if self._started:
+                return
+            await self.rescan()
+            if not self._start_inotify():
+                log.info(f"Watching {self._image_dir} by polling every {self._poll_interval}s")
+                self._poll_task = asyncio.create_task(self._poll_loop())
+            self._started = True
+
+    async def close(self):
+        self._started = False
+        self._stop_inotify()
+        for task in (self._poll_task, self._update_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._poll_task = None
+        self._update_task = None
+
+    def get_names(self) -> List[str]:
+        return sorted(name for name, info in self._entries.items() if info.error is None)
+
+    def get(self, name: str) -> Optional[ImageInfo]:
+        return self._entries.get(name)
+
+    def get_entries(self) -> List[ImageInfo]:
+        return [self._entries[name] for name in sorted(self._entries)]
+
+    async def rescan(self):
+        """ Compares the directory with the index and reads the files that changed """
+        listing = await asyncio.get_running_loop().run_in_executor(None, self._list_dir)
+        removed = [name for name in self._entries if name not in listing]
+        await self._update(listing, removed)
+
+    async def _update_names(self, names: Iterable[str]):
+        listing = await asyncio.get_running_loop().run_in_executor(None, self._stat_names, list(names))
+        removed = [name for name in names if name not in listing and name in self._entries]
+        await self._update(listing, removed)
+
+    async def _update(self, listing: Dict[str, os.stat_result], removed: List[str]):
+        changed = [
+            name for name, stat in listing.items()
+            if name not in self._entries
+            or self._entries[name].mtime_ns != stat.st_mtime_ns
+            or self._entries[name].file_size != stat.st_size
+        ]
+        if not changed and not removed:
+            return
+        loop = asyncio.get_running_loop()
+        infos = await asyncio.gather(*(loop.run_in_executor(None, self._read_info, name) for name in changed))
+        for name in removed:
+            self._entries.pop(name, None)
+        for info in infos:
+            if info is not None:
+                self._entries[info.name] = info
+        log.debug(f"Image index updated, {len(changed)} changed, {len(removed)} removed")
+        self._version += 1
+        for listener in self._listeners:
+            listener()
+
+    def _read_info(self, name: str) -> Optional[ImageInfo]:
+        try:
+            return read_image_info(self._image_dir / name)
+        except OSError:
+            # removed again before it was read, the next event removes it from the index
+            return None
+
+    def _list_dir(self) -> Dict[str, os.stat_result]:
+        listing = {}
+        try:
+            with os.scandir(self._image_dir) as entries:
+                for entry in entries:
+                    if Path(entry.name).suffix.lower() in IMAGE_EXTENSIONS and entry.is_file():
+                        listing[entry.name] = entry.stat()
+        except FileNotFoundError:
+            pass
+        return listing
+
+    def _stat_names(self, names: List[str]) -> Dict[str, os.stat_result]:
+        listing = {}
+        for name in names:
+            try:
+                stat = (self._image_dir / name).stat()
+            except OSError:
+                continue
+            if os.path.isfile(self._image_dir / name):
+                listing[name] = stat
+        return listing
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            try:
+                await self.rescan()
+            except Exception as e:
+                log.error(f"Failed to scan {self._image_dir}: {e}")
+            # the directory might exist now
+            if self._start_inotify():
+                self._poll_task = None
+                return
+
+    def _start_inotify(self) -> bool:
+        libc = _load_inotify()
+        if libc is None or not self._image_dir.is_dir():
+            return False
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            log.warning(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+            return False
+        if libc.inotify_add_watch(fd, os.fsencode(self._image_dir), WATCH_MASK) < 0:
+            log.warning(f"inotify_add_watch failed: {os.strerror(ctypes.get_errno())}")
+            os.close(fd)
+            return False
+        self._inotify_fd = fd
+        asyncio.get_running_loop().add_reader(fd, self._on_inotify)
+        log.info(f"Watching {self._image_dir} with inotify")
+        return True
+
+    def _stop_inotify(self):
+        if self._inotify_fd is not None:
+            asyncio.get_running_loop().remove_reader(self._inotify_fd)
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+        if self._settle_handle is not None:
+            self._settle_handle.cancel()
+            self._settle_handle = None
+
+    def _on_inotify(self):
+        try:
+            data = os.read(self._inotify_fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        watch_lost = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_len].rstrip(b"\0")
+            offset += EVENT_HEADER.size + name_len
+            if mask & IN_Q_OVERFLOW:
+                self._full_rescan = True
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                watch_lost = True
+            elif name:
+                name = os.fsdecode(name)
+                if Path(name).suffix.lower() in IMAGE_EXTENSIONS:
+                    self._pending.add(name)
+        if watch_lost:
+            log.warning(f"{self._image_dir} was removed or moved, falling back to polling")
+            self._stop_inotify()
+            self._full_rescan = True
+            self._poll_task = asyncio.create_task(self._poll_loop())
+        if self._settle_handle is None and (self._pending or self._full_rescan):
+            self._settle_handle = asyncio.get_running_loop().call_later(self._settle_delay, self._schedule_update)
+
+    def _schedule_update(self):
+        self._settle_handle = None
+        if self._update_task is None or self._update_task.done():
+            self._update_task = asyncio.create_task(self._handle_pending())
+
+    async def _handle_pending(self):
+        while self._pending or self._full_rescan:
+            pending, self._pending = self._pending, set()
+            full_rescan, self._full_rescan = self._full_rescan, False
+            try:
+                if full_rescan:
+                    await self.rescan()
+                else:
+                    await self._update_names(pending)
+            except Exception as e:
+                log.error(f"Failed to update the image index: {e}")
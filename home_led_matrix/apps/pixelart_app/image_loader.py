@@ -0,0 +1,55 @@
+import logging
+import numpy as np
+from pathlib import Path
+from dataclasses import dataclass
+from typing import Tuple
+from PIL import Image, ImageOps, ImageSequence
+
+log = logging.getLogger(Path(__file__).stem)
+
+IMAGE_EXTENSIONS = {".png", ".gif", ".jpg", ".jpeg", ".bmp", ".webp"}
+
+# Browsers treat very short GIF frame durations as 100 ms, so do we
+MIN_FRAME_DURATION = 0.02
+DEFAULT_FRAME_DURATION = 0.1
+# A still image is shown as one frame of this duration repeated, so the player stays responsive
+STILL_FRAME_DURATION = 0.25
+
+
+@dataclass
+class Animation:
+    frames: np.ndarray  # (N, height, width, 3) uint8
+    durations: np.ndarray  # (N,) seconds per frame
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def nbytes(self) -> int:
+        return self.frames.nbytes + self.durations.nbytes
+
+
+def _fit(frame: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """ Scale to fit inside size keeping the aspect ratio, padded with black """
+    frame = frame.convert("RGBA")
+    background = Image.new("RGBA", frame.size, (0, 0, 0, 255))
+    frame = Image.alpha_composite(background, frame).convert("RGB")
+    # pixel art is scaled up with nearest neighbour to keep it crisp, photos are scaled down smoothly
+    upscale = frame.width <= size[0] and frame.height <= size[1]
+    return ImageOps.pad(frame, size, method=Image.NEAREST if upscale else Image.LANCZOS, color=(0, 0, 0))
+
+
+def decode_image(path: Path, size: Tuple[int, int]) -> Animation:
+    """ Decodes every frame of an image to RGB arrays of the given (width, height). Blocking, run it in an executor """
+    frames = []
+    durations = []
+    with Image.open(path) as image:
+        animated = getattr(image, "is_animated", False)
+        for frame in ImageSequence.Iterator(image):
+            frames.append(np.asarray(_fit(frame, size)))
+            if animated:
+                duration = frame.info.get("duration", image.info.get("duration", 0)) / 1000
+                durations.append(duration if duration >= MIN_FRAME_DURATION else DEFAULT_FRAME_DURATION)
+            else:
+                durations.append(STILL_FRAME_DURATION)
+    return Animation(frames=np.stack(frames), durations=np.array(durations, dtype=np.float64))
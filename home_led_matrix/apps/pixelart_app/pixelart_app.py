@@ -1,29 +1,264 @@
+import asyncio
+import time
+import logging
+from pathlib import Path
+from typing import List, Optional
+
+from home_led_matrix.utils import convert_arg, to_bool, ConfigPersist
 from home_led_matrix.display.display_handler import DisplayHandler
 from home_led_matrix.apps.app_interface import IAsyncApp
+from home_led_matrix.apps.frame_clock import FrameClock
+from home_led_matrix.apps.pixelart_app.image_loader import Animation
+from home_led_matrix.apps.pixelart_app.frame_cache import FrameCache
+from home_led_matrix.apps.pixelart_app.image_index import ImageIndex
+
+log = logging.getLogger(Path(__file__).stem)
 
 
 class PixelArtApp(IAsyncApp):
-    def __init__(self, image_dir: str):
+    def __init__(self, image_dir: str, frame_cache_mb: int = 64, atlas_dir: Optional[str] = None, atlas_size_mb: int = 256):
         self.image_dir = image_dir
+        self._frame_cache = FrameCache(int(frame_cache_mb) * 1024 * 1024, atlas_dir or None, int(atlas_size_mb) * 1024 * 1024)
+        self._preload_task: Optional[asyncio.Task] = None
+        self._image_index = ImageIndex(Path(image_dir))
+        self._image_index.add_listener(self._on_index_changed)
+        self._index_task: Optional[asyncio.Task] = None
         self.display_handler = DisplayHandler()
         self._is_running = False
+        self._config = ConfigPersist("pixelart_config")
+        self._config.setdefault("image", "")
+        self._config.setdefault("slideshow", True)
+        self._config.setdefault("slide_duration", 10)
+        # images to cycle through in slideshow mode, empty means every image in image_dir
+        self._config.setdefault("playlist", [])
+        if not self._config.slide_duration > 0:
+            log.warning(f"Invalid slide duration {self._config.slide_duration} in the config, resetting it to 10")
+            self._config.slide_duration = 10
+        self._config.save()
+        self._unpaused_event = asyncio.Event()
+        self._stop_event = asyncio.Event()
+        # set when the image should change before the current one is done
+        self._change_event = asyncio.Event()
+        self._frame_clock = FrameClock(fps=10, name="pixelart")
+        self._animation: Optional[Animation] = None
+        self._frame_index = 0
+        # images that failed to load, skipped until the index changes
+        self._broken: set = set()
+        self._broken_version = 0
 
     async def run(self):
+        log.debug("Starting pixel art app")
         self._is_running = True
+        self._unpaused_event.set()
+        self._stop_event.clear()
+        try:
+            await self._play_loop()
+        except asyncio.CancelledError:
+            await self.stop()
+
+    def start_index(self):
+        """ Starts indexing image_dir in the background, the first scan reads every image so it can take a while """
+        if self._index_task is None or (self._index_task.done() and (self._index_task.cancelled() or self._index_task.exception())):
+            self._index_task = asyncio.create_task(self._image_index.start())
+
+    async def _get_index(self) -> ImageIndex:
+        self.start_index()
+        # shielded, a getter timing out must not cancel the scan
+        await asyncio.shield(self._index_task)
+        return self._image_index
+
+    def _on_index_changed(self):
+        # the current image or a playlist entry may have been added or removed
+        if self._config.image not in self._image_index.get_names():
+            self._change_event.set()
+
+    async def close(self):
+        if self._index_task is not None:
+            self._index_task.cancel()
+            await asyncio.gather(self._index_task, return_exceptions=True)
+        await self._image_index.close()
+
+    async def _get_playlist(self) -> List[str]:
+        images = (await self._get_index()).get_names()
+        if self._config.playlist:
+            images = [image for image in self._config.playlist if image in images]
+        return images
+
+    async def _load(self, image: str) -> Optional[Animation]:
+        size = (self.display_handler.width, self.display_handler.height)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self._frame_cache.get, Path(self.image_dir, image), size)
+        except Exception as e:
+            log.error(f"Failed to load {image}: {e}")
+            return None
+
+    async def _play_loop(self):
+        while not self._stop_event.is_set():
+            if not self._unpaused_event.is_set():
+                await self._unpaused_event.wait()
+            self._change_event.clear()
+            playlist = await self._get_playlist()
+            if self._image_index.version != self._broken_version:
+                # a broken file may have been fixed or replaced
+                self._broken.clear()
+                self._broken_version = self._image_index.version
+            image = self._config.image
+            if image not in playlist or image in self._broken:
+                image = self._next_image(playlist, image)
+            animation = await self._load(image) if image else None
+            if animation is None:
+                if image:
+                    self._broken.add(image)
+                if self._next_image(playlist, image):
+                    # skip the broken image
+                    continue
+                if self._unpaused_event.is_set():
+                    self.display_handler.clear(owner=self)
+                await self._wait_for_change(5)
+                # nothing could be loaded, try all of them again
+                self._broken.clear()
+                continue
+            if image != self._config.image:
+                self._config.set("image", image)
+            next_image = self._next_image(playlist, image)
+            slideshow = self._config.slideshow and next_image not in ("", image)
+            if slideshow:
+                self._preload(next_image)
+            await self._play(animation, self._config.slide_duration if slideshow else None)
+            if not self._change_event.is_set() and slideshow:
+                self._config.set("image", next_image)
+
+    def _next_image(self, playlist: List[str], image: str) -> str:
+        """ The entry after image in the playlist that did not fail to load, the first one if image is not in it.
+        Empty if every entry failed """
+        start = playlist.index(image) + 1 if image in playlist else 0
+        for i in range(len(playlist)):
+            candidate = playlist[(start + i) % len(playlist)]
+            if candidate not in self._broken:
+                return candidate
+        return ""
+
+    def _preload(self, image: str):
+        """ Decode the next image of the slideshow into the frame cache while the current one plays """
+        if self._preload_task is None or self._preload_task.done():
+            self._preload_task = asyncio.create_task(self._load(image))
+
+    async def _wait_for_change(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._change_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _play(self, animation: Animation, hold: Optional[float]):
+        """ Plays the animation in a loop, until hold seconds have passed or the image is changed """
+        self._animation = animation
+        self._frame_index = 0
+        self._frame_clock.reset()
+        end = time.monotonic() + hold if hold is not None else None
+        drawn = False
+        while not (self._stop_event.is_set() or self._change_event.is_set()):
+            if not self._unpaused_event.is_set():
+                await self._unpaused_event.wait()
+                self._frame_clock.reset()
+            await self._frame_clock.tick(animation.durations[self._frame_index])
+            if not self._unpaused_event.is_set():
+                continue
+            # the first frame is always shown
+            if drawn and end is not None and time.monotonic() >= end:
+                break
+            self._show_frame()
+            drawn = True
+            self._frame_index = (self._frame_index + 1) % len(animation)
+
+    def _show_frame(self):
+        if self._animation is not None:
+            self.display_handler.set_frame(self._animation.frames[self._frame_index], owner=self)
+            self.display_handler.show(owner=self)
 
     async def stop(self):
         self._is_running = False
-        self.display_handler.clear()
+        self._stop_event.set()
+        self._change_event.set()
+        self.display_handler.clear(owner=self)
 
     async def pause(self):
         self._is_running = False
-        self.display_handler.clear()
+        self._unpaused_event.clear()
+        self.display_handler.clear(owner=self)
 
     async def resume(self):
         self._is_running = True
+        self._unpaused_event.set()
+
+    async def prepare(self):
+        """ Indexes the images and decodes the first one into the frame cache """
+        playlist = await self._get_playlist()
+        image = self._config.image if self._config.image in playlist else (playlist[0] if playlist else "")
+        if image:
+            await self._load(image)
+
+    async def suspend(self):
+        # like pause, but the display is left to the next app
+        self._is_running = False
+        self._unpaused_event.clear()
 
     async def redraw(self):
-        pass
+        self._show_frame()
 
     async def is_running(self):
-        return self._is_running
\ No newline at end of file
+        return self._is_running
+
+    async def get_images(self) -> List[str]:
+        return (await self._get_index()).get_names()
+
+    async def get_image_index(self) -> List[dict]:
+        return [info.to_dict() for info in (await self._get_index()).get_entries()]
+
+    async def get_image_info(self) -> Optional[dict]:
+        info = (await self._get_index()).get(self._config.image)
+        return info.to_dict() if info is not None else None
+
+    @convert_arg(str)
+    async def set_image(self, value):
+        if value not in await self.get_images():
+            raise ValueError(f"No such image: {value}")
+        self._config.set("image", value)
+        self._change_event.set()
+
+    async def get_image(self):
+        return self._config.image
+
+    async def next_image(self):
+        playlist = await self._get_playlist()
+        if playlist:
+            index = playlist.index(self._config.image) + 1 if self._config.image in playlist else 0
+            await self.set_image(playlist[index % len(playlist)])
+
+    @convert_arg(to_bool)
+    async def set_slideshow(self, value):
+        self._config.set("slideshow", value)
+        self._change_event.set()
+
+    async def get_slideshow(self):
+        return self._config.slideshow
+
+    @convert_arg(float)
+    async def set_slide_duration(self, value):
+        if not value > 0:
+            raise ValueError(f"Slide duration must be greater than 0, got {value}")
+        self._config.set("slide_duration", value)
+
+    async def get_slide_duration(self):
+        return self._config.slide_duration
+
+    async def set_playlist(self, value):
+        if isinstance(value, str):
+            value = [image.strip() for image in value.split(",") if image.strip()]
+        self._config.set("playlist", list(value))
+        self._change_event.set()
+
+    async def get_playlist(self):
+        return self._config.playlist
+
+    async def get_cache_stats(self):
+        return self._frame_cache.get_stats()
@@ -0,0 +1,203 @@
+import os
+import shutil
+import random
+import logging
+import numpy as np
+from pathlib import Path
+from collections import deque
+from typing import List, Optional
+
+from snake_proto_template.python.sim_msgs_pb2 import RunMetaData
+
+from home_led_matrix.apps.snake_app.stream_handler import PIXEL_DTYPE, StepPixelChangesData
+
+log = logging.getLogger(Path(__file__).stem)
+
+# A cached run is a directory with these files, the .npy files are memory mapped when replayed:
+#   meta.pb      serialized RunMetaData
+#   pixels.npy   every changed pixel of the run, PIXEL_DTYPE
+#   frames.npy   offsets into pixels, sub-frame i is pixels[frames[i]:frames[i + 1]]
+#   steps.npy    offsets into frames, step i is frames[steps[i]:steps[i + 1] + 1]
+META_FILE = "meta.pb"
+PIXELS_FILE = "pixels.npy"
+FRAMES_FILE = "frames.npy"
+STEPS_FILE = "steps.npy"
+
+
+class RunRecorder:
+    """ Collects the steps of a run in order, as they are displayed """
+
+    def __init__(self, run_id: str, init_data: RunMetaData):
+        self.run_id = run_id
+        self._init_data = init_data
+        self._sub_frames: List[np.ndarray] = []
+        self._step_offsets = [0]
+        self._broken = False
+
+    @property
+    def step_count(self) -> int:
+        return len(self._step_offsets) - 1
+
+    def add_step(self, step_data: StepPixelChangesData):
+        if step_data.step != self.step_count:
+            if not self._broken:
+                log.debug(f"Not recording run {self.run_id}, got step {step_data.step} expected {self.step_count}")
+            self._broken = True
+            return
+        self._sub_frames.extend(step_data.pixel_data)
+        self._step_offsets.append(len(self._sub_frames))
+
+    @property
+    def broken(self) -> bool:
+        """ True if a step was missed, the recording can not be replayed then """
+        return self._broken
+
+    def write(self, path: Path):
+        counts = [len(sub_frame) for sub_frame in self._sub_frames]
+        pixels = np.concatenate(self._sub_frames) if self._sub_frames else np.zeros(0, dtype=PIXEL_DTYPE)
+        np.save(path / PIXELS_FILE, pixels.astype(PIXEL_DTYPE, copy=False))
+        np.save(path / FRAMES_FILE, np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+        np.save(path / STEPS_FILE, np.array(self._step_offsets, dtype=np.int64))
+        (path / META_FILE).write_bytes(self._init_data.SerializeToString())
+
+
+class CachedRun:
+    """ A recorded run, memory mapped from disk """
+
+    def __init__(self, path: Path):
+        self.run_id = path.name
+        self.init_data = RunMetaData()
+        self.init_data.ParseFromString((path / META_FILE).read_bytes())
+        self._pixels = np.load(path / PIXELS_FILE, mmap_mode="r")
+        self._frames = np.load(path / FRAMES_FILE, mmap_mode="r")
+        self._steps = np.load(path / STEPS_FILE, mmap_mode="r")
+
+    @property
+    def step_count(self) -> int:
+        return len(self._steps) - 1
+
+    def get_step(self, step: int) -> StepPixelChangesData:
+        first, last = self._steps[step], self._steps[step + 1]
+        offsets = self._frames[first:last + 1]
+        return StepPixelChangesData(
+            step=step,
+            pixel_data=deque(self._pixels[start:end] for start, end in zip(offsets[:-1], offsets[1:]))
+        )
+
+    def pixels_until(self, step: int) -> np.ndarray:
+        """ Every pixel change before the given step, in order """
+        return self._pixels[:self._frames[self._steps[step]]]
+
+
+class ReplayHandler:
+    """ Plays a cached run through the same interface as StreamHandler """
+
+    def __init__(self, run: CachedRun, start_step: int = 0):
+        self._run = run
+        self._position = 0
+        self.seek(start_step)
+
+    def get_init_data(self):
+        return self._run.init_data
+
+    def seek(self, step: int):
+        self._position = max(0, min(step, self._run.step_count))
+
+    def get_position(self) -> int:
+        return self._position
+
+    def render(self, frame: np.ndarray):
+        """ Draws the state of the run at the current position onto frame, which should hold the map """
+        pixels = self._run.pixels_until(self._position)
+        if not len(pixels):
+            return
+        # only the last change of each pixel matters, fancy assignment does not guarantee the order of duplicates
+        linear = pixels["y"].astype(np.intp) * frame.shape[1] + pixels["x"]
+        _, last = np.unique(linear[::-1], return_index=True)
+        last = len(pixels) - 1 - last
+        frame[pixels["y"][last], pixels["x"][last]] = pixels["color"][last]
+
+    def get_next_step_pixel_change(self) -> Optional[StepPixelChangesData]:
+        if self._position >= self._run.step_count:
+            return None
+        step_data = self._run.get_step(self._position)
+        self._position += 1
+        return step_data
+
+    def get_buffer_depth(self) -> int:
+        return self._run.step_count - self._position
+
+    def get_remaining_steps(self) -> Optional[int]:
+        return self._run.step_count - self._position
+
+    def set_fps(self, fps: float):
+        pass
+
+    def is_done(self):
+        return self._position >= self._run.step_count
+
+    async def stop(self):
+        pass
+
+
+class RunCache:
+    """ Directory of recorded runs, the least recently played runs are evicted when it grows past max_bytes """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self._cache_dir = Path(cache_dir).expanduser()
+        self._max_bytes = max_bytes
+
+    def _run_dirs(self) -> List[Path]:
+        if not self._cache_dir.exists():
+            return []
+        return [p for p in self._cache_dir.iterdir() if p.is_dir() and not p.name.startswith(".")]
+
+    def get_run_ids(self) -> List[str]:
+        return sorted(p.name for p in self._run_dirs())
+
+    def has_runs(self) -> bool:
+        return bool(self._run_dirs())
+
+    def open(self, run_id: str) -> CachedRun:
+        path = self._cache_dir / run_id
+        if not path.is_dir():
+            raise KeyError(f"No cached run: {run_id}")
+        # the directory mtime is the LRU timestamp
+        os.utime(path)
+        return CachedRun(path)
+
+    def open_random(self) -> Optional[CachedRun]:
+        run_dirs = self._run_dirs()
+        if not run_dirs:
+            return None
+        return self.open(random.choice(run_dirs).name)
+
+    def save(self, recorder: RunRecorder):
+        """ Blocking, run it in an executor """
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        final_path = self._cache_dir / recorder.run_id
+        tmp_path = self._cache_dir / f".{recorder.run_id}.{os.getpid()}.tmp"
+        try:
+            tmp_path.mkdir()
+            recorder.write(tmp_path)
+            if final_path.exists():
+                shutil.rmtree(final_path)
+            os.replace(tmp_path, final_path)
+            log.debug(f"Cached run {recorder.run_id} with {recorder.step_count} steps")
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        runs = []
+        total = 0
+        for path in self._run_dirs():
+            size = sum(f.stat().st_size for f in path.iterdir())
+            runs.append((path.stat().st_mtime, size, path))
+            total += size
+        runs.sort()
+        while runs and total > self._max_bytes:
+            _, size, path = runs.pop(0)
+            log.debug(f"Evicting cached run {path.name}")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -1,36 +1,77 @@
 import asyncio
+import hashlib
 import numpy as np
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
+from collections import OrderedDict
 
-from home_led_matrix.utils import convert_arg, async_get_request, ConfigPersist
+from home_led_matrix.utils import convert_arg, async_get_request, ConfigPersist, AsyncTTLCache
 from home_led_matrix.display.display_handler import DisplayHandler
 from home_led_matrix.apps.app_interface import IAsyncApp
+from home_led_matrix.apps.frame_clock import FrameClock
+from home_led_matrix.apps.transitions import TransitionEngine
+from home_led_matrix.metrics import Metrics
 from home_led_matrix.apps.snake_app.stream_handler import StreamHandler, request_run
+from home_led_matrix.apps.snake_app.run_cache import RunCache, RunRecorder, ReplayHandler
 
 log = logging.getLogger(Path(__file__).stem)
 
 display_handler = DisplayHandler()
+metrics = Metrics()
+
+MAP_CACHE_SIZE = 8
+
+
+def build_map_layer(base_map: np.ndarray, blocked_value: int, color: Tuple[int, int, int]) -> np.ndarray:
+    """ Expands the map by 2 into an RGB frame, blocked cells and the gaps between blocked neighbours are filled with color """
+    height, width = base_map.shape
+    blocked = base_map == blocked_value
+    mask = np.zeros((height * 2, width * 2), dtype=bool)
+    mask[::2, ::2] = blocked
+    # join horizontal and vertical neighbours by filling the pixel between them
+    mask[::2, 1:-1:2] = blocked[:, :-1] & blocked[:, 1:]
+    mask[1:-1:2, ::2] = blocked[:-1, :] & blocked[1:, :]
+    layer = np.zeros((height * 2, width * 2, 3), dtype=np.uint8)
+    layer[mask] = color
+    return layer
+
 
 class SnakeApp(IAsyncApp):
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, run_cache_dir: Optional[str] = None, run_cache_size_mb: int = 256):
         self._host = host
         self._port = port
-        self._stream_handler = StreamHandler()
+        self._run_cache = RunCache(run_cache_dir, int(run_cache_size_mb) * 1024 * 1024) if run_cache_dir else None
+        self._recorder: Optional[RunRecorder] = None
+        self._replay_request: Optional[str] = None
+        self._changes_queue = None
+        self._remote_cache = AsyncTTLCache(ttl=60)
         self._config = ConfigPersist("run_config")
         self._config.setdefault("nr_snakes", 7)
         self._config.setdefault("food", 15)
         self._config.setdefault("food_decay", 0)
         self._config.setdefault("fps", 10)
         self._config.setdefault("map", "")
+        # Request and buffer the next run this many seconds before the current one ends, 0 disables it
+        self._config.setdefault("prewarm_seconds", 5)
+        if not self._config.fps > 0:
+            # saved by an older version that accepted any fps
+            log.warning(f"Invalid fps {self._config.fps} in the config, resetting it to 10")
+            self._config.fps = 10
         self._config.save()
+        self._stream_handler = StreamHandler(fps=self._config.fps)
         self._current_run_id = None
         self._unpaused_event = asyncio.Event()
         self._restart_event = asyncio.Event()
         self._stop_event = asyncio.Event()
         self._stream_task: Optional[asyncio.Task] = None
+        self._prewarm_task: Optional[asyncio.Task] = None
+        self._started = False
         self._last_frame = None
+        self._frame_clock = FrameClock(self._config.fps, name="snake")
+        self._map_layers: OrderedDict[Tuple[str, str], np.ndarray] = OrderedDict()
+        # bumped by seek, a sub-frame taken before the seek is not drawn
+        self._seek_generation = 0
 
     async def main_loop(self):
         self._stop_event.clear()
@@ -40,20 +81,113 @@ class SnakeApp(IAsyncApp):
                     break
                 if not self._unpaused_event.is_set():
                     await self._unpaused_event.wait()
+                if self._restart_event.is_set():
+                    # settings may have changed, a run prepared with the old ones is not wanted
+                    await self._discard_prewarmed_run()
                 self._restart_event.clear()
                 try:
-                    await self._request_new_run()
-                    await self._start_stream(self._current_run_id)
+                    run = await self._take_prewarmed_run()
+                    try:
+                        # the app can be suspended while the run is requested, the run starts when it is back
+                        await self._wait_unpaused()
+                    except BaseException:
+                        await run[1].stop()
+                        raise
+                    await self._start_run(run)
                     await self._display_loop()
+                    await self._save_recording()
                 finally:
                     await self._stream_handler.stop()
-                # Let the final state be displayed for 10 seconds
+                # Let the final state be displayed for 10 seconds, while the next run is buffering
                 if not (self._stop_event.is_set() or self._restart_event.is_set()):
+                    self._start_prewarm()
                     await asyncio.sleep(10)
         except asyncio.CancelledError:
             await self.stop()
+        finally:
+            await self._discard_prewarmed_run()
+
+    async def _wait_unpaused(self) -> bool:
+        """ Returns True if the app was paused """
+        if self._unpaused_event.is_set():
+            return False
+        await self._unpaused_event.wait()
+        return True
+
+    async def _prepare_run(self) -> Tuple[str, StreamHandler]:
+        """ Requests a run and starts buffering its stream, without touching the display.
+        Falls back to a cached run if the server is unavailable """
+        if self._replay_request is not None:
+            run_id, self._replay_request = self._replay_request, None
+            return run_id, ReplayHandler(self._run_cache.open(run_id))
+        run_id = await self._request_new_run()
+        if run_id is None:
+            cached_run = self._run_cache.open_random()
+            log.info(f"Server unavailable, replaying cached run {cached_run.run_id}")
+            return cached_run.run_id, ReplayHandler(cached_run)
+        stream_handler = StreamHandler(fps=self._config.fps)
+        try:
+            await stream_handler.start_stream(run_id, self._host, self._port)
+            self.get_map_layer(stream_handler.get_init_data())
+        except BaseException:
+            await stream_handler.stop()
+            raise
+        return run_id, stream_handler
+
+    def _start_prewarm(self):
+        if self._prewarm_task is None and self._config.prewarm_seconds > 0:
+            log.debug("Pre-warming the next run")
+            self._prewarm_task = asyncio.create_task(self._prepare_run())
+
+    def _maybe_start_prewarm(self):
+        remaining = self._stream_handler.get_remaining_steps()
+        if remaining is not None and remaining <= self._config.prewarm_seconds * self._config.fps:
+            self._start_prewarm()
+
+    async def _take_prewarmed_run(self) -> Tuple[str, StreamHandler]:
+        task, self._prewarm_task = self._prewarm_task, None
+        if task is None:
+            return await self._prepare_run()
+        try:
+            return await task
+        except Exception as e:
+            log.error(f"Pre-warming the next run failed: {e}")
+            return await self._prepare_run()
+
+    async def _discard_prewarmed_run(self):
+        task, self._prewarm_task = self._prewarm_task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            _, stream_handler = await task
+            await stream_handler.stop()
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    async def _start_run(self, run: Tuple[str, StreamHandler]):
+        self._current_run_id, self._stream_handler = run
+        self._stream_handler.set_fps(self._config.fps)
+        self._changes_queue = None
+        init_data = self._stream_handler.get_init_data()
+        if isinstance(self._stream_handler, StreamHandler) and self._run_cache is not None:
+            self._recorder = RunRecorder(self._current_run_id, init_data)
+        if self._last_frame is not None and display_handler.is_owner(self):
+            # blend from the end of the previous run, the first run after a switch is blended by the AppHandler
+            TransitionEngine().begin()
+        await self.load_map(init_data)
 
-    async def _request_new_run(self):
+    async def _save_recording(self):
+        recorder, self._recorder = self._recorder, None
+        if recorder is None or recorder.broken or self._stream_handler.get_remaining_steps() != 0:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._run_cache.save, recorder)
+        except Exception as e:
+            log.error(f"Failed to cache run {recorder.run_id}: {e}")
+
+    async def _request_new_run(self) -> Optional[str]:
+        """ Returns None if the request failed and there are cached runs to fall back on """
         config = {
             'snake_count': self._config.nr_snakes,
             'food': self._config.food,
@@ -64,71 +198,99 @@ class SnakeApp(IAsyncApp):
             'start_length': 3
         }
         log.debug(f"requesting run with config: {config}")
-        self._current_run_id = await request_run(self._host, self._port, config)
-        if self._current_run_id is None:
+        can_replay = self._run_cache is not None and self._run_cache.has_runs()
+        run_id = await request_run(self._host, self._port, config, retries=1 if can_replay else 10)
+        if run_id is None:
+            if can_replay:
+                return None
             log.error("Failed to request run, stopping everything")
             raise asyncio.CancelledError
-
-    async def _start_stream(self, run_id):
-        await self._stream_handler.start_stream(run_id, self._host, self._port)
-        init_data = self._stream_handler.get_init_data()
-        await self.load_map(init_data)
+        return run_id
 
     async def _display_frame(self, frame: np.ndarray):
-        for y in range(frame.shape[0]):
-            for x in range(frame.shape[1]):
-                display_handler.set_pixel(x, y, frame[y, x])
+        if not self._unpaused_event.is_set():
+            # redraw() shows the frame after the resume
+            return
+        display_handler.set_frame(frame, owner=self)
+        display_handler.show(owner=self)
 
-    async def load_map(self, init_data):
-        base_map = np.frombuffer(bytes(init_data.base_map), dtype=init_data.base_map_dtype).reshape(init_data.height, init_data.width)
+    def get_map_layer(self, init_data) -> np.ndarray:
+        """ Returns the expanded map frame for the run, cached per map name and init data """
+        raw_map = bytes(init_data.base_map)
         color_mapping = self.get_color_mapping(init_data)
-        self._last_frame = np.zeros((init_data.height * 2, init_data.width * 2, 3), dtype=np.uint8)
-        pixel_changes = []
-        for y in range(init_data.height):
-            for x in range(init_data.width):
-                if base_map[y, x] == init_data.blocked_value:
-                    color = color_mapping[base_map[y, x]]
-                    exp_x = x * 2 # expand by 2 offset by 1
-                    exp_y = y * 2
-                    pixel_changes.append((exp_x, exp_y, color))
-                    for x_d, y_d in [(1, 0), (0, 1), (-1, 0), (0, -1)]:
-                        if not (0 <= y + y_d < init_data.height and 0 <= x + x_d < init_data.width):
-                            continue
-                        if base_map[y + y_d, x + x_d] == init_data.blocked_value:
-                            pixel_changes.append((exp_x + x_d, exp_y + y_d, color))
-        display_handler.clear()
-        self._update_display(pixel_changes)
+        digest = hashlib.blake2b(raw_map, digest_size=16)
+        digest.update(repr((
+            init_data.base_map_dtype,
+            init_data.width,
+            init_data.height,
+            init_data.blocked_value,
+            color_mapping.get(init_data.blocked_value)
+        )).encode())
+        key = (self._config.map, digest.hexdigest())
+        layer = self._map_layers.get(key)
+        if layer is not None:
+            self._map_layers.move_to_end(key)
+            return layer
+        base_map = np.frombuffer(raw_map, dtype=init_data.base_map_dtype).reshape(init_data.height, init_data.width)
+        color = color_mapping.get(init_data.blocked_value, (0, 0, 0))
+        layer = build_map_layer(base_map, init_data.blocked_value, color)
+        layer.flags.writeable = False
+        self._map_layers[key] = layer
+        if len(self._map_layers) > MAP_CACHE_SIZE:
+            self._map_layers.popitem(last=False)
+        return layer
+
+    async def load_map(self, init_data):
+        # Compose the whole map frame before handing it over, so the panel never shows a blank frame
+        self._last_frame = self.get_map_layer(init_data).copy()
+        await self._display_frame(self._last_frame)
 
     def get_color_mapping(self, init_data):
         return {int(k): (v.r, v.g, v.b) for k, v in init_data.color_mapping.items()}
 
     async def _display_loop(self):
-        changes_queue = None
+        self._frame_clock.reset()
         while True:
             if self._restart_event.is_set() or self._stop_event.is_set():
                 break
-            if not self._unpaused_event.is_set():
-                await self._unpaused_event.wait()
-            if not changes_queue:
+            if await self._wait_unpaused():
+                self._frame_clock.reset()
+            if not self._changes_queue:
                 step_pixel_changes = self._stream_handler.get_next_step_pixel_change()
+                if step_pixel_changes is not None and self._recorder is not None:
+                    self._recorder.add_step(step_pixel_changes)
             if step_pixel_changes is None:
                 if self._stream_handler.is_done():
                     log.debug("Run is finished")
                     break
                 await asyncio.sleep(0.1)
                 continue
-            changes_queue = step_pixel_changes.pixel_data
-            current_pixel_changes = changes_queue.popleft()
-            self._update_display(current_pixel_changes)
-            await asyncio.sleep(1 / self._config.fps)
-
-    def _update_display(self, pixel_changes):
-        for x, y, color in pixel_changes:
-            display_handler.set_pixel(x, y, color)
-            self._last_frame[y, x] = color
+            self._changes_queue = step_pixel_changes.pixel_data
+            current_pixel_changes = self._changes_queue.popleft()
+            seek_generation = self._seek_generation
+            await self._frame_clock.tick()
+            if seek_generation != self._seek_generation:
+                # seeked while waiting for the frame, the sub-frame is from the old position
+                continue
+            if not self._unpaused_event.is_set():
+                # suspended while waiting for the frame, it is shown after the resume
+                self._changes_queue.appendleft(current_pixel_changes)
+                continue
+            with metrics.timer("snake.update_display_ms"):
+                self._update_display(current_pixel_changes)
+            metrics.observe("snake.buffer_depth", self._stream_handler.get_buffer_depth())
+            self._maybe_start_prewarm()
+
+    def _update_display(self, pixel_changes: np.ndarray):
+        if len(pixel_changes):
+            xs, ys, colors = pixel_changes["x"], pixel_changes["y"], pixel_changes["color"]
+            self._last_frame[ys, xs] = colors
+            display_handler.set_pixels(xs, ys, colors, owner=self)
+        display_handler.show(owner=self)
 
     async def run(self):
         log.debug("Starting snake app")
+        self._started = True
         self._unpaused_event.set()
         self._restart_event.clear()
         self._stop_event.clear()
@@ -136,6 +298,24 @@ class SnakeApp(IAsyncApp):
             await self.main_loop()
         except asyncio.CancelledError:
             await self.stop()
+        finally:
+            self._started = False
+
+    async def prepare(self):
+        """ Requests and buffers the first run, so it can be shown as soon as the app is started """
+        if self._started:
+            return
+        if self._prewarm_task is None:
+            self._prewarm_task = asyncio.create_task(self._prepare_run())
+        task = self._prewarm_task
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+        except Exception as e:
+            # run() tries again
+            log.error(f"Preparing a run failed: {e}")
 
     async def stop(self):
         self._stop_event.set()
@@ -147,8 +327,8 @@ class SnakeApp(IAsyncApp):
         self._unpaused_event.set()
 
     async def redraw(self):
-        display_handler.clear()
-        await self._display_frame(self._last_frame)
+        if self._last_frame is not None:
+            await self._display_frame(self._last_frame)
 
     async def is_running(self):
         return self._unpaused_event is None or self._unpaused_event.is_set()
@@ -169,17 +349,27 @@ class SnakeApp(IAsyncApp):
 
     @convert_arg(int)
     async def set_fps(self, value):
+        if not value > 0:
+            raise ValueError(f"fps must be greater than 0, got {value}")
+        self._frame_clock.set_fps(value)
         self._config.set('fps', value)
+        self._stream_handler.set_fps(value)
 
     async def get_fps(self):
         return self._config.fps
 
+    async def get_frame_stats(self):
+        return self._frame_clock.get_stats()
+
     @convert_arg(str)
     async def set_map(self, value):
         if value.lower() == "none":
             value = ""
-        if value not in await self.get_maps() + [""]:
-            return
+        if value and value not in (await self.get_maps() or []):
+            # the map could have been added on the server since the list was cached
+            self._remote_cache.invalidate("maps")
+            if value not in (await self.get_maps() or []):
+                return
         self._config.set('map', value)
 
     async def get_map(self):
@@ -193,11 +383,41 @@ class SnakeApp(IAsyncApp):
         return self._config.nr_snakes
 
     async def get_maps(self):
+        return await self._remote_cache.get("maps", self._fetch_maps)
+
+    async def _fetch_maps(self):
         return await async_get_request(f"http://{self._host}:{self._port}/api/map_names")
 
     async def restart(self):
         self._restart_event.set()
 
+    async def get_cached_runs(self):
+        return self._run_cache.get_run_ids() if self._run_cache is not None else []
+
+    @convert_arg(str)
+    async def replay(self, value):
+        """ Restart with a cached run instead of a new one from the server """
+        if value not in await self.get_cached_runs():
+            raise ValueError(f"No cached run: {value}")
+        self._replay_request = value
+        await self.restart()
+
+    @convert_arg(int)
+    async def seek(self, value):
+        if not isinstance(self._stream_handler, ReplayHandler):
+            raise ValueError("Can only seek while replaying a cached run")
+        self._stream_handler.seek(value)
+        self._changes_queue = None
+        self._seek_generation += 1
+        frame = self.get_map_layer(self._stream_handler.get_init_data()).copy()
+        self._stream_handler.render(frame)
+        self._last_frame = frame
+        await self._display_frame(self._last_frame)
+
+    async def get_seek(self):
+        if isinstance(self._stream_handler, ReplayHandler):
+            return self._stream_handler.get_position()
+
 
 
 
@@ -0,0 +1,66 @@
+from typing import Any, List, Optional
+
+
+class StepRingBuffer:
+    """ Fixed capacity buffer of steps keyed by step number.
+
+    Steps can arrive in any order as long as they fall inside the window [read_step, read_step + capacity),
+    they are handed out in order by pop(). Every operation is O(1) and memory is bounded by the capacity.
+    Items only need a 'step' attribute. """
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._slots: List[Optional[Any]] = [None] * capacity
+        self._read_step = 0
+        self._ready_end = 0
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def read_step(self) -> int:
+        """ The next step pop() will return """
+        return self._read_step
+
+    @property
+    def ready_end(self) -> int:
+        """ The first step after read_step that has not been received """
+        return self._ready_end
+
+    def ready(self) -> int:
+        """ Number of steps that can be popped without a gap """
+        return self._ready_end - self._read_step
+
+    def fits(self, step: int) -> bool:
+        return self._read_step <= step < self._read_step + self._capacity
+
+    def reset(self, start_step: int = 0):
+        self._slots = [None] * self._capacity
+        self._read_step = start_step
+        self._ready_end = start_step
+
+    def put(self, item) -> bool:
+        """ Returns False if the step was dropped, because it is already consumed, buffered or outside the window """
+        step = item.step
+        if not self.fits(step):
+            return False
+        index = step % self._capacity
+        if self._slots[index] is not None:
+            return False
+        self._slots[index] = item
+        while self._ready_end < self._read_step + self._capacity and self._slots[self._ready_end % self._capacity] is not None:
+            self._ready_end += 1
+        return True
+
+    def pop(self):
+        if self._read_step == self._ready_end:
+            return None
+        index = self._read_step % self._capacity
+        item = self._slots[index]
+        self._slots[index] = None
+        self._read_step += 1
+        return item
+
+    def __len__(self):
+        return self.ready()
@@ -1,13 +1,19 @@
 import logging
+import math
+import time
 import aiohttp
 import asyncio
 import websockets
+import numpy as np
 from home_led_matrix.utils import async_post_request
 from typing import List, Tuple, Dict, Optional, Deque
 from pathlib import Path
 from collections import deque
 from dataclasses import dataclass
 
+from home_led_matrix.apps.snake_app.step_buffer import StepRingBuffer
+from home_led_matrix.metrics import Metrics
+
 from snake_proto_template.python.sim_msgs_pb2 import (
     Request,
     BadRequest,
@@ -24,6 +30,12 @@ from snake_proto_template.python.sim_msgs_pb2 import (
 
 log = logging.getLogger(Path(__file__).stem)
 
+metrics = Metrics()
+
+
+# One record per changed pixel, a sub-frame is a 1d array of these
+PIXEL_DTYPE = np.dtype([("x", np.uint8), ("y", np.uint8), ("color", np.uint8, (3,))])
+
 
 class OutOfOrderError(Exception):
     pass
@@ -32,20 +44,21 @@ class OutOfOrderError(Exception):
 @dataclass
 class StepPixelChangesData:
     step: int
-    pixel_data: Deque[List[Tuple[int, int, Tuple[int, int, int]]]]
+    pixel_data: Deque[np.ndarray]  # sub-frames of the step, each an array of PIXEL_DTYPE
 
 
 class StreamHandler:
-    def __init__(self) -> None:
+    def __init__(self, capacity: int = 1024, min_buffer_size: int = 20, min_batch_size: int = 10, fps: float = 10) -> None:
         self._websocket = None
-        self._min_buffer_size = 50
-        self._min_batch_size = 10
-        self._recieved_data: deque[StepPixelChangesData] = deque()
-        self._staging_data: Dict[int, StepPixelChangesData] = {}
+        self._min_buffer_size = min_buffer_size
+        self._min_batch_size = min_batch_size
+        self._fps = fps
+        self._buffer = StepRingBuffer(capacity)
+        # When each buffered step was requested, indexed like the ring buffer, 0 when not in flight
+        self._requested_at = np.zeros(capacity, dtype=np.float64)
+        self._requested_until = 0
+        self._rtt = None
         self._init_data = None
-        self._last_added_to_buffer = None
-        self._received_steps = set()
-        self._requested_steps = set()
         self._final_step = None
         self._init_data_recieved = asyncio.Event()
         self._stream_finished_event = asyncio.Event()
@@ -116,12 +129,15 @@ class StreamHandler:
 
     def process_message(self, data):
         msg = MsgWrapper()
-        msg.ParseFromString(data)
+        with metrics.timer("stream.decode_ms"):
+            msg.ParseFromString(data)
         log.debug(f"recieved message: Type = {MessageType.Name(msg.type)}")
         if msg.type == MessageType.PIXEL_CHANGES:
             pixel_changes = StepPixelChanges()
-            pixel_changes.ParseFromString(msg.payload)
-            self._handle_pixel_changes(pixel_changes)
+            with metrics.timer("stream.pixel_decode_ms"):
+                pixel_changes.ParseFromString(msg.payload)
+            with metrics.timer("stream.pixel_changes_ms"):
+                self._handle_pixel_changes(pixel_changes)
         if msg.type == MessageType.RUN_META_DATA:
             global meta_data
             meta_data = RunMetaData()
@@ -137,34 +153,30 @@ class StreamHandler:
             bad_request = BadRequest()
             bad_request.ParseFromString(msg.payload)
             log.error(f"Bad request: {bad_request}")
-        if self._final_step is not None and self._last_added_to_buffer >= self._final_step:
+        if self._final_step is not None and self._buffer.ready_end > self._final_step:
             self._finish_stream()
 
     def _handle_pixel_changes(self, step_pixel_changes: StepPixelChanges):
-        self._received_steps.add(step_pixel_changes.step)
-        pixel_changes_data = deque()
-        for change in step_pixel_changes.changes:
-            pixel_changes_data.append([(p.coord.x, p.coord.y, (p.color.r, p.color.g, p.color.b)) for p in change.pixels])
+        step = step_pixel_changes.step
+        if not self._buffer.fits(step):
+            log.debug(f"Dropping step outside of the buffer window: {step}")
+            return
+        self._sample_rtt(step)
         step_pixel_changes_obj = StepPixelChangesData(
-            step=step_pixel_changes.step,
-            pixel_data=pixel_changes_data
+            step=step,
+            pixel_data=decode_pixel_changes(step_pixel_changes)
         )
-        # If the step is the same as the last recieved step, append to the last recieved data
-        # Otherwise, stage the data, and move it to the recieved data when it is the next step in the sequence
-        if (self._last_added_to_buffer is None or step_pixel_changes.step == self._last_added_to_buffer + 1):
-            self._add_to_recieved_data(step_pixel_changes_obj)
-        elif step_pixel_changes.step <= self._last_added_to_buffer:
-            log.debug(f"Dropping already added step: {step_pixel_changes.step}")
-        else:
-            self._staging_data[step_pixel_changes.step] = step_pixel_changes_obj
-        self._move_staged_data()
-
-    def _add_to_recieved_data(self, step_pixel_changes_data: StepPixelChangesData):
-        if self._last_added_to_buffer is None or step_pixel_changes_data.step == self._last_added_to_buffer + 1:
-            self._recieved_data.append(step_pixel_changes_data)
-            self._last_added_to_buffer = step_pixel_changes_data.step
-        else:
-            raise OutOfOrderError(f"Added step out of order: {step_pixel_changes_data.step} after {self._last_added_to_buffer}")
+        # Steps can arrive out of order, the ring buffer hands them out in order
+        if not self._buffer.put(step_pixel_changes_obj):
+            log.debug(f"Dropping already added step: {step}")
+
+    def _sample_rtt(self, step):
+        index = step % self._buffer.capacity
+        requested_at = self._requested_at[index]
+        if requested_at > 0:
+            sample = time.monotonic() - requested_at
+            self._rtt = sample if self._rtt is None else 0.8 * self._rtt + 0.2 * sample
+            self._requested_at[index] = 0
 
     async def _request_pixel_changes(self, start_step, end_step):
         log.debug(f"Requesting: start = {start_step}, end = {end_step}")
@@ -174,47 +186,39 @@ class StreamHandler:
                 payload=PixelChangesReq(start_step=start_step, end_step=end_step).SerializeToString()
             )
             await self.send(req.SerializeToString())
-            self._requested_steps.update(range(start_step, end_step + 1))
+            self._requested_at[np.arange(start_step, end_step + 1) % self._buffer.capacity] = time.monotonic()
+            self._requested_until = max(self._requested_until, end_step + 1)
         except Exception as e:
             log.error(e)
             log.debug("TRACE: ", exc_info=True)
 
-    def _move_staged_data(self):
-        while True:
-            next_step = self._last_added_to_buffer + 1
-            if next_step in self._staging_data:
-                self._add_to_recieved_data(self._staging_data.pop(next_step))
-            else:
-                break
-
-    def _create_request_ranges(self, from_step, to_step):
-        ranges = []
-        r_start, r_end = None, None
-        for i in range(from_step, to_step + 1):
-            if i not in self._requested_steps:
-                if r_start is None:
-                    r_start = i
-                r_end = i
-            else:
-                if r_start is not None:
-                    ranges.append((r_start, r_end))
-                    r_start, r_end = None, None
-        if r_start is not None:
-            ranges.append((r_start, r_end))
-        return ranges
+    def set_fps(self, fps: float):
+        self._fps = fps
+
+    def get_prefetch_depth(self) -> int:
+        """ How many steps to keep requested ahead of the reader, enough to cover the round trip at the current fps """
+        if self._rtt is None:
+            return self._min_buffer_size
+        depth = math.ceil(self._fps * self._rtt * 2) + self._min_batch_size
+        return max(self._min_buffer_size, min(depth, self._buffer.capacity))
 
     async def _request_more_if_needed(self):
         # check if we need to request more data, could be missing steps or just need more data
-        if self._final_step is not None and max(self._requested_steps) >= self._final_step:
+        last_step = self._final_step if self._final_step is not None else math.inf
+        missing = self._buffer.ready_end
+        if missing < self._requested_until and missing <= last_step:
+            # re-request a step that should have arrived long ago
+            requested_at = self._requested_at[missing % self._buffer.capacity]
+            timeout = max(1.0, 4 * self._rtt) if self._rtt is not None else 5.0
+            if requested_at > 0 and time.monotonic() - requested_at > timeout:
+                log.debug(f"Step {missing} timed out, requesting it again")
+                await self._request_pixel_changes(missing, int(min(missing + self._min_batch_size, self._requested_until, last_step + 1)) - 1)
+        if self._requested_until > last_step:
             return
-        if len(self._recieved_data) < (self._min_buffer_size - self._min_batch_size):
-            from_step = max(self._requested_steps) + 1 if self._requested_steps else 0
-            to_step = from_step + (self._min_buffer_size - len(self._recieved_data))
-            if self._final_step is not None:
-                to_step = max(to_step, self._final_step)
-            ranges = self._create_request_ranges(from_step, to_step)
-            for r in ranges:
-                await self._request_pixel_changes(*r)
+        target = min(self._buffer.read_step + self.get_prefetch_depth(), self._buffer.read_step + self._buffer.capacity)
+        to_step = min(target, last_step + 1)
+        if to_step - self._requested_until >= min(self._min_batch_size, last_step + 1 - self._requested_until):
+            await self._request_pixel_changes(self._requested_until, int(to_step) - 1)
 
     async def _request_init_data(self):
         self._init_data_recieved.clear()
@@ -232,24 +236,30 @@ class StreamHandler:
 
     def get_next_step_pixel_change(self) -> Optional[StepPixelChangesData]:
         self._request_more_event.set()
-        if self._recieved_data:
-            return self._recieved_data.popleft()
+        return self._buffer.pop()
+
+    def get_buffer_depth(self) -> int:
+        return self._buffer.ready()
+
+    def get_remaining_steps(self) -> Optional[int]:
+        """ Steps left to hand out, None until the final step is known """
+        if self._final_step is None:
+            return None
+        return max(0, self._final_step + 1 - self._buffer.read_step)
 
     def get_init_data(self):
         return self._init_data
 
     def _reset(self):
-        self._recieved_data.clear()
+        self._buffer.reset()
+        self._requested_at.fill(0)
+        self._requested_until = 0
         self._init_data_recieved.clear()
         self._stream_finished_event.clear()
         self._init_data = None
-        self._received_steps = set()
-        self._requested_steps = set()
-        self._staging_data = {}
         self._final_step = None
         self._receive_task = None
         self._request_task = None
-        self._last_added_to_buffer = None
 
     def _finish_stream(self):
         log.debug("Stream is stopped internally")
@@ -274,16 +284,21 @@ class StreamHandler:
         return self._receive_task is None or self._receive_task.done()
 
 
-async def request_run(host, port, config, retries: int = 10) -> str:
+def decode_pixel_changes(step_pixel_changes: StepPixelChanges) -> Deque[np.ndarray]:
+    """ Decodes all sub-frames of a step into one PIXEL_DTYPE array in a single pass, returns a view per sub-frame """
+    changes = step_pixel_changes.changes
+    counts = [len(change.pixels) for change in changes]
+    pixels = np.fromiter(
+        ((p.coord.x, p.coord.y, (p.color.r, p.color.g, p.color.b)) for change in changes for p in change.pixels),
+        dtype=PIXEL_DTYPE,
+        count=sum(counts)
+    )
+    return deque(np.split(pixels, np.cumsum(counts)[:-1]))
+
+
+async def request_run(host, port, config, retries: int = 10) -> Optional[str]:
     uri = f'http://{host}:{port}/api/request_run'
-    for attempt in range(1, retries + 1):
-        log.debug(f"Attempt {attempt} to request run")
-        try:
-            run_id = await async_post_request(uri, config)
-            if run_id and run_id.get("result") == "success":
-                return run_id.get('run_id')
-            else:
-                log.error(f"Failed to request run: {run_id}")
-        except Exception as e:
-            log.error(f"Error requesting run: {e}")
-        await asyncio.sleep(10 * attempt)  # Exponential backoff
+    run_id = await async_post_request(uri, config, retries=retries - 1, backoff=5, max_backoff=100)
+    if run_id and run_id.get("result") == "success":
+        return run_id.get('run_id')
+    log.error(f"Failed to request run: {run_id}")
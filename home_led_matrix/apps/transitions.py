@@ -0,0 +1,148 @@
+import asyncio
+import time
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Optional
+
+from home_led_matrix.utils import SingletonMeta, ConfigPersist, convert_arg
+from home_led_matrix.display.display_handler import DisplayHandler
+from home_led_matrix.apps.frame_clock import FrameClock
+
+log = logging.getLogger(Path(__file__).stem)
+
+display_handler = DisplayHandler()
+
+NONE = "none"
+CROSSFADE = "crossfade"
+WIPE = "wipe"  # the new frame is revealed from left to right
+DISSOLVE = "dissolve"  # the new frame is revealed pixel by pixel in random order
+
+TRANSITIONS = (NONE, CROSSFADE, WIPE, DISSOLVE)
+
+
+def crossfade(src: np.ndarray, dst: np.ndarray, progress: float, out: np.ndarray):
+    # fixed point, weights out of 256
+    weight = int(progress * 256)
+    blended = src.astype(np.uint16) * (256 - weight)
+    blended += dst.astype(np.uint16) * weight
+    np.right_shift(blended, 8, out=blended)
+    out[...] = blended
+
+
+def wipe(src: np.ndarray, dst: np.ndarray, progress: float, out: np.ndarray):
+    edge = int(round(progress * src.shape[1]))
+    out[:, :edge] = dst[:, :edge]
+    out[:, edge:] = src[:, edge:]
+
+
+def dissolve(src: np.ndarray, dst: np.ndarray, progress: float, out: np.ndarray, ranks: np.ndarray):
+    """ ranks is a permutation of the pixel indices shaped like the frame, pixels with a rank below progress show dst """
+    mask = ranks < progress * ranks.size
+    np.copyto(out, src)
+    np.copyto(out, dst, where=mask[..., None])
+
+
+class TransitionEngine(metaclass=SingletonMeta):
+    """ Blends from what is on the panel to whatever is drawn next, over a configurable duration.
+
+    begin() takes a snapshot of the panel and installs a frame filter on the DisplayHandler,
+    which blends the snapshot with every frame that is shown until the transition is done.
+    The panel is refreshed at fps meanwhile, so the blend advances even if the app draws less often. """
+
+    def __init__(self, fps: float = 40):
+        self._config = ConfigPersist("transition_config")
+        self._config.setdefault("kind", CROSSFADE)
+        self._config.setdefault("duration", 0.5)
+        self._config.save()
+        self._fps = fps
+        self._src: Optional[np.ndarray] = None
+        self._out: Optional[np.ndarray] = None
+        self._ranks: Optional[np.ndarray] = None
+        self._kind = NONE
+        self._started_at = 0.0
+        self._duration = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._rng = np.random.default_rng()
+
+    @property
+    def active(self) -> bool:
+        return self._src is not None
+
+    def begin(self):
+        """ Start a transition from the frame currently on the panel, call it before drawing the new content """
+        kind, duration = self._config.kind, float(self._config.duration)
+        if kind == NONE or duration <= 0:
+            return
+        # starting over in the middle of a transition blends from the half blended frame on the panel
+        self._src = display_handler.get_displayed_frame()
+        self._out = np.empty_like(self._src)
+        if kind == DISSOLVE:
+            height, width = self._src.shape[:2]
+            self._ranks = self._rng.permutation(height * width).reshape(height, width)
+        self._kind = kind
+        self._duration = duration
+        self._started_at = time.monotonic()
+        display_handler.set_frame_filter(self._filter)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    def _progress(self) -> float:
+        return min(1.0, (time.monotonic() - self._started_at) / self._duration)
+
+    def _filter(self, frame: np.ndarray) -> np.ndarray:
+        if self._src is None:
+            return frame
+        progress = self._progress()
+        if self._kind == CROSSFADE:
+            crossfade(self._src, frame, progress, self._out)
+        elif self._kind == WIPE:
+            wipe(self._src, frame, progress, self._out)
+        elif self._kind == DISSOLVE:
+            dissolve(self._src, frame, progress, self._out, self._ranks)
+        else:
+            return frame
+        return self._out
+
+    async def _refresh_loop(self):
+        clock = FrameClock(self._fps)
+        try:
+            while self._src is not None and self._progress() < 1:
+                await clock.tick()
+                display_handler.show()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        self._src = None
+        self._ranks = None
+        display_handler.set_frame_filter(None)
+        display_handler.show()
+
+    async def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    @convert_arg(str)
+    async def set_transition(self, value):
+        value = value.lower()
+        if value not in TRANSITIONS:
+            raise ValueError(f"Unknown transition: {value}, must be one of {TRANSITIONS}")
+        self._config.set("kind", value)
+
+    async def get_transition(self):
+        return self._config.kind
+
+    async def get_transitions(self):
+        return list(TRANSITIONS)
+
+    @convert_arg(float)
+    async def set_duration(self, value):
+        self._config.set("duration", max(0.0, value))
+
+    async def get_duration(self):
+        return self._config.duration
@@ -1,3 +1,5 @@
+import time
+import uuid
 import logging
 import zmq
 import zmq.asyncio
@@ -5,11 +7,11 @@ import asyncio
 
 from threading import Thread, Event
 from pathlib import Path
-from typing import Dict, Any, Callable
+from typing import Dict, Any, Callable, Awaitable, Optional, AsyncIterator
 from importlib import resources
 from configparser import ConfigParser
 
-from home_led_matrix.message_handler import IMessageHandler, MessageHandler, Request, Response, Update
+from home_led_matrix.message_handler import IMessageHandler, MessageHandler, Request, Response, Update, JSON, resolve_encoding
 
 log = logging.getLogger(Path(__file__).stem)
 
@@ -28,12 +30,69 @@ def setup_logging():
     log.addHandler(ch)
 
 
+class UpdateCoalescer:
+    """ Merges updates of the same key that arrive within window seconds and publishes a key at most
+    once per min_interval seconds. The latest value of every key is always published eventually. """
+
+    def __init__(self, publish: Callable[[Dict[str, Any]], Awaitable], window: float = 0.05, min_interval: float = 0.2):
+        self._publish = publish
+        self._window = window
+        self._min_interval = min_interval
+        self._pending: Dict[str, Any] = {}
+        self._last_published: Dict[str, float] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def submit(self, updates: Dict[str, Any]):
+        self._pending.update(updates)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        try:
+            await asyncio.sleep(self._window)
+            while self._pending:
+                now = time.monotonic()
+                due = {
+                    key: value for key, value in self._pending.items()
+                    if now - self._last_published.get(key, -self._min_interval) >= self._min_interval
+                }
+                for key in due:
+                    del self._pending[key]
+                    self._last_published[key] = now
+                if due:
+                    try:
+                        await self._publish(due)
+                    except zmq.ZMQError as e:
+                        log.error(e)
+                    except Exception as e:
+                        # the loop keeps going, so the keys still pending are published
+                        log.error(e, exc_info=True)
+                if self._pending:
+                    next_due = min(self._last_published.get(key, 0) + self._min_interval for key in self._pending)
+                    await asyncio.sleep(max(0, next_due - time.monotonic()))
+        except Exception as e:
+            log.error(e, exc_info=True)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+
+
 class ConnServer:
 
     def __init__(self,
             route_port=conf["CONNECTION"]["route_port"],
             pub_port=conf["CONNECTION"]["pub_port"],
-            host=conf["CONNECTION"]["host"]):
+            host=conf["CONNECTION"]["host"],
+            max_workers=conf["CONNECTION"].getint("max_workers", 4),
+            client_queue_size=conf["CONNECTION"].getint("client_queue_size", 16),
+            pub_encoding=conf["CONNECTION"].get("pub_encoding", JSON),
+            update_window=conf["CONNECTION"].getfloat("update_window", 0.05),
+            update_min_interval=conf["CONNECTION"].getfloat("update_min_interval", 0.2)):
         self._route_port = route_port
         self._pub_port = pub_port
         self._host = host
@@ -43,6 +102,16 @@ class ConnServer:
         self._client_ids = set()
         self._is_running = False
         self._message_handler: IMessageHandler = None
+        # Requests are queued per client and handled in order by one worker per client,
+        # at most max_workers requests are handled at the same time
+        self._client_queue_size = client_queue_size
+        self._client_queues: Dict[bytes, asyncio.Queue] = {}
+        self._client_workers: Dict[bytes, asyncio.Task] = {}
+        self._worker_slots = asyncio.Semaphore(max_workers)
+        self._pending = 0
+        # Replies use the encoding of the request, updates go to every subscriber so they use a fixed one
+        self._pub_encoding = resolve_encoding(pub_encoding)
+        self._update_coalescer = UpdateCoalescer(self._publish_update, update_window, update_min_interval)
 
     def set_message_handler(self, handler: IMessageHandler):
         self._message_handler = handler
@@ -51,28 +120,108 @@ class ConnServer:
         return await self._message_handler.handle_msg(message)
 
     async def _send_update(self, response: Response):
+        self._update_coalescer.submit(response.sets)
+
+    def publish(self, updates: Dict[str, Any]):
+        """ Publish key updates to the subscribers, through the same coalescing as the replies to sets """
+        self._update_coalescer.submit(updates)
+
+    async def _publish_update(self, updates: Dict[str, Any]):
         update = Update()
-        for key, value in response.sets.items():
+        for key, value in updates.items():
             update.update(key, value)
-        await self._pub_socket.send_string(update.to_json())
+        await self._pub_socket.send(update.encode(self._pub_encoding))
+
+    async def _reply(self, client_id: bytes, response: Response, encoding: str = JSON):
+        if response.sets:
+            await self._send_update(response)
+        await self._route_socket.send_multipart([client_id, response.encode(encoding)])
+
+    async def _process(self, client_id: bytes, request: Request, encoding: str):
+        request_id = getattr(request, "id", None)
+        if getattr(request, "partial", False):
+            async for response in self._message_handler.handle_msg_partial(request):
+                response.id = request_id
+                await self._reply(client_id, response, encoding)
+        else:
+            response = await self._handle_message(request)
+            response.id = request_id
+            await self._reply(client_id, response, encoding)
+
+    async def _client_worker(self, client_id: bytes, queue: asyncio.Queue):
+        try:
+            while not queue.empty():
+                request, encoding = queue.get_nowait()
+                try:
+                    async with self._worker_slots:
+                        await self._process(client_id, request, encoding)
+                except zmq.ZMQError as e:
+                    log.error(e)
+                except Exception as e:
+                    log.error(e, exc_info=True)
+                finally:
+                    self._pending -= 1
+                    queue.task_done()
+        finally:
+            # the worker only lives while the client has requests queued
+            if queue.empty() and self._client_queues.get(client_id) is queue:
+                del self._client_queues[client_id]
+            del self._client_workers[client_id]
+
+    async def _dispatch(self, client_id: bytes, request: Request, encoding: str):
+        queue = self._client_queues.get(client_id)
+        if queue is None:
+            queue = self._client_queues[client_id] = asyncio.Queue(self._client_queue_size)
+        try:
+            queue.put_nowait((request, encoding))
+        except asyncio.QueueFull:
+            # the receive loop is shared by every client, a flooding client is told it is busy instead of stalling it
+            log.warning(f"Request queue of '{client_id.hex()}' is full, rejecting the request")
+            await self._reply_busy(client_id, request, encoding)
+            return
+        self._pending += 1
+        if client_id not in self._client_workers:
+            self._client_queues[client_id] = queue
+            self._client_workers[client_id] = asyncio.create_task(self._client_worker(client_id, queue))
+
+    async def _reply_busy(self, client_id: bytes, request: Request, encoding: str):
+        response = Response()
+        response.id = getattr(request, "id", None)
+        response.busy = True
+        for key in getattr(request, "gets", []):
+            response.error(key, "get", "busy")
+        for key in getattr(request, "sets", {}):
+            response.error(key, "set", "busy")
+        for action in getattr(request, "actions", []):
+            response.error(action, "action", "busy")
+        try:
+            await self._route_socket.send_multipart([client_id, response.encode(encoding)])
+        except zmq.ZMQError as e:
+            log.error(e)
+
+    def get_queue_depth(self) -> int:
+        """ Requests received but not yet answered """
+        return self._pending
+
+    async def get_queue_depths(self) -> Dict[str, int]:
+        return {"total": self._pending, **{client_id.hex(): queue.qsize() for client_id, queue in self._client_queues.items()}}
 
     async def _loop(self):
         try:
             while self._is_running:
                 client_id, message = await self._route_socket.recv_multipart()
-                request = Request.from_json(message.decode())
+                try:
+                    request, encoding = Request.decode(message)
+                except Exception as e:
+                    log.error(f"Invalid request from '{client_id.hex()}': {e}")
+                    continue
                 log.debug(f"Received from '{client_id.hex()}': {request}")
 
                 if client_id not in self._client_ids:
                     self._client_ids.add(client_id)
                     log.info(f"New client connected: {client_id.hex()}")
 
-                response = await self._handle_message(request)
-                if response.sets:
-                    await self._send_update(response)
-
-                resp = [client_id, response.to_json().encode()]
-                await self._route_socket.send_multipart(resp)
+                await self._dispatch(client_id, request, encoding)
         except KeyboardInterrupt:
             pass
         except zmq.ZMQError as e:
@@ -95,6 +244,10 @@ class ConnServer:
             log.error(e, exc_info=True)
 
     async def _cleanup(self):
+        for worker in list(self._client_workers.values()):
+            worker.cancel()
+        await asyncio.gather(*self._client_workers.values(), return_exceptions=True)
+        await self._update_coalescer.close()
         if self._route_socket: self._route_socket.close()
         if self._pub_socket: self._pub_socket.close()
         if self._context: self._context.term()
@@ -109,10 +262,12 @@ class ConnClient():
     def __init__(self,
             route_port=conf["CONNECTION"]["route_port"],
             sub_port=conf["CONNECTION"]["pub_port"],
-            host=conf["CONNECTION"]["host"]):
+            host=conf["CONNECTION"]["host"],
+            encoding=JSON):
         self._route_port = route_port
         self._sub_port = sub_port
         self._host = host
+        self._encoding = encoding
         self._context = zmq.Context()
         self._dealer_socket = self._context.socket(zmq.DEALER)
         self._dealer_socket.setsockopt(zmq.LINGER, 5000)
@@ -125,8 +280,8 @@ class ConnClient():
     def _listen_loop(self):
         try:
             while not self._stop_listening_event.is_set():
-                message = self._sub_socket.recv_string()
-                update = Update.from_json(message)
+                message = self._sub_socket.recv()
+                update, _ = Update.decode(message)
                 log.debug(f"Received update: {update}")
                 self._update_handler(update.updates)
         except zmq.ZMQError as e:
@@ -153,24 +308,142 @@ class ConnClient():
 
     def _send_message(self, message: Request):
         try:
-            self._dealer_socket.send_string(message.to_json())
+            self._dealer_socket.send(message.encode(self._encoding))
         except zmq.ZMQError as e:
             log.error(e)
 
-    def request(self, message: Request) -> Response:
+    def request(self, message: Request, timeout: float = 3) -> Response:
+        message.id = uuid.uuid4().hex
         self._send_message(message)
-        if self._dealer_socket.poll(3000) == zmq.POLLIN:
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            if self._dealer_socket.poll(int(remaining * 1000)) != zmq.POLLIN:
+                break
             frames = self._dealer_socket.recv_multipart()
-            print(frames)
-            if len(frames) == 2:
-                response = frames[1].decode()
-            else:
-                response = frames[0].decode()
+            response, _ = Response.decode(frames[-1])
+            # responses to earlier requests that timed out, or partial responses, are skipped
+            if getattr(response, "id", None) not in (message.id, None) or getattr(response, "partial", False):
+                log.debug(f"Skipping response: {response}")
+                continue
             log.debug(f"Received response: {response}")
-            return Response.from_json(response)
-        else:
-            log.error("No response received")
-            return Response()
+            return response
+        log.error("No response received")
+        return Response()
+
+
+class AsyncConnClient:
+    """ asyncio client, many requests can be in flight over the one DEALER socket,
+    responses are matched to their request by id """
+
+    def __init__(self,
+            route_port=conf["CONNECTION"]["route_port"],
+            sub_port=conf["CONNECTION"]["pub_port"],
+            host=conf["CONNECTION"]["host"],
+            encoding=JSON,
+            timeout: float = 3):
+        self._route_port = route_port
+        self._sub_port = sub_port
+        self._host = host
+        self._encoding = encoding
+        self._timeout = timeout
+        self._context = zmq.asyncio.Context()
+        self._dealer_socket = None
+        self._receive_task: Optional[asyncio.Task] = None
+        self._in_flight: Dict[str, asyncio.Queue] = {}
+
+    async def __aenter__(self):
+        self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def connect(self):
+        self._dealer_socket = self._context.socket(zmq.DEALER)
+        self._dealer_socket.setsockopt(zmq.LINGER, 0)
+        self._dealer_socket.connect(f"tcp://{self._host}:{self._route_port}")
+        self._receive_task = asyncio.create_task(self._receive_loop())
+
+    async def _receive_loop(self):
+        try:
+            while True:
+                frames = await self._dealer_socket.recv_multipart()
+                try:
+                    response, _ = Response.decode(frames[-1])
+                except Exception as e:
+                    log.error(f"Invalid response: {e}")
+                    continue
+                queue = self._in_flight.get(getattr(response, "id", None))
+                if queue is None:
+                    log.debug(f"Dropping response to a request that is no longer waiting: {response}")
+                    continue
+                queue.put_nowait(response)
+        except asyncio.CancelledError:
+            pass
+        except zmq.ZMQError as e:
+            log.error(e)
+
+    async def _send(self, message: Request) -> asyncio.Queue:
+        if self._dealer_socket is None:
+            raise RuntimeError("Not connected, call connect() first")
+        message.id = uuid.uuid4().hex
+        queue = self._in_flight[message.id] = asyncio.Queue()
+        try:
+            await self._dealer_socket.send(message.encode(self._encoding))
+        except BaseException:
+            del self._in_flight[message.id]
+            raise
+        return queue
+
+    async def request(self, message: Request, timeout: Optional[float] = None) -> Response:
+        """ Raises asyncio.TimeoutError if there is no response in time, a late response is dropped """
+        message.partial = False
+        queue = await self._send(message)
+        try:
+            return await asyncio.wait_for(queue.get(), self._timeout if timeout is None else timeout)
+        finally:
+            self._in_flight.pop(message.id, None)
+
+    async def request_partial(self, message: Request, timeout: Optional[float] = None) -> AsyncIterator[Response]:
+        """ Yields the partial responses as they arrive, the last one yielded is the final response.
+        timeout applies to the wait for each response """
+        message.partial = True
+        queue = await self._send(message)
+        try:
+            while True:
+                response = await asyncio.wait_for(queue.get(), self._timeout if timeout is None else timeout)
+                yield response
+                if not response.partial:
+                    break
+        finally:
+            self._in_flight.pop(message.id, None)
+
+    async def updates(self) -> AsyncIterator[Dict[str, Any]]:
+        """ Yields the updates published by the server, as dicts of changed keys """
+        sub_socket = self._context.socket(zmq.SUB)
+        sub_socket.setsockopt(zmq.LINGER, 0)
+        sub_socket.connect(f"tcp://{self._host}:{self._sub_port}")
+        sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        try:
+            while True:
+                try:
+                    message = await sub_socket.recv()
+                except (zmq.ZMQError, asyncio.CancelledError):
+                    # closing the socket in close() cancels the pending recv, the updates just end
+                    if sub_socket.closed:
+                        return
+                    raise
+                update, _ = Update.decode(message)
+                yield update.updates
+        finally:
+            sub_socket.close()
+
+    async def close(self):
+        if self._receive_task is not None:
+            self._receive_task.cancel()
+            await asyncio.gather(self._receive_task, return_exceptions=True)
+        # term() would block until every socket is closed, including the SUB sockets of updates() still open
+        self._context.destroy(linger=0)
 
 
 if __name__ == "__main__":
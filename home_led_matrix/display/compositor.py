@@ -0,0 +1,164 @@
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional
+
+log = logging.getLogger(Path(__file__).stem)
+
+
+class Layer:
+    """ An RGBA overlay, drawn above the app frame. Layers with a higher z are drawn on top.
+
+    The drawing methods mark the layer dirty, call mark_dirty() after writing to rgba directly. """
+
+    def __init__(self, name: str, z: int, width: int, height: int):
+        self.name = name
+        self._z = z
+        self.rgba = np.zeros((height, width, 4), dtype=np.uint8)
+        self._visible = True
+        self._dirty = True
+
+    @property
+    def z(self) -> int:
+        return self._z
+
+    @z.setter
+    def z(self, value: int):
+        if value != self._z:
+            self._z = value
+            self._dirty = True
+
+    @property
+    def visible(self) -> bool:
+        return self._visible
+
+    @visible.setter
+    def visible(self, value: bool):
+        if value != self._visible:
+            self._visible = value
+            self._dirty = True
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def mark_clean(self):
+        self._dirty = False
+
+    def clear(self):
+        self.rgba.fill(0)
+        self._dirty = True
+
+    def fill(self, color, alpha: int = 255):
+        self.rgba[..., :3] = color
+        self.rgba[..., 3] = alpha
+        self._dirty = True
+
+    def set_pixels(self, xs: np.ndarray, ys: np.ndarray, colors: np.ndarray, alpha: int = 255):
+        """ Scatter write, colors is an (N, 3) or (N, 4) array, alpha is used for (N, 3) """
+        colors = np.asarray(colors)
+        if colors.shape[-1] == 4:
+            self.rgba[ys, xs] = colors
+        else:
+            self.rgba[ys, xs, :3] = colors
+            self.rgba[ys, xs, 3] = alpha
+        self._dirty = True
+
+    def draw(self, image: np.ndarray, x: int = 0, y: int = 0, alpha: int = 255):
+        """ Copies an (h, w, 3) or (h, w, 4) array to the layer at x, y, clipped to the layer """
+        height, width = self.rgba.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + image.shape[1], width), min(y + image.shape[0], height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        src = image[y0 - y:y1 - y, x0 - x:x1 - x]
+        if src.shape[2] == 4:
+            self.rgba[y0:y1, x0:x1] = src
+        else:
+            self.rgba[y0:y1, x0:x1, :3] = src
+            self.rgba[y0:y1, x0:x1, 3] = alpha
+        self._dirty = True
+
+
+class Compositor:
+    """ Blends the overlay layers over the app frame.
+
+    Each layer is converted to premultiplied float once when it changes, and the layers are folded into one
+    cached overlay (color, transmittance) when any of them changed. compose() then only touches the pixels
+    some overlay covers, so a static overlay costs one masked multiply-add per frame and no overlay costs nothing. """
+
+    def __init__(self, width: int, height: int):
+        self._width = width
+        self._height = height
+        self._layers: Dict[str, Layer] = {}
+        # per layer premultiplied color and alpha, refreshed when the layer is dirty
+        self._premultiplied: Dict[str, tuple] = {}
+        self._stack_dirty = False
+        # flat indices of the covered pixels, with the folded overlay color and transmittance at those pixels
+        self._covered: Optional[np.ndarray] = None
+        self._color: Optional[np.ndarray] = None
+        self._transmittance: Optional[np.ndarray] = None
+        self._out = np.zeros((height, width, 3), dtype=np.uint8)
+
+    def add_layer(self, name: str, z: int = 1) -> Layer:
+        if name in self._layers:
+            raise ValueError(f"Layer {name} already exists")
+        layer = Layer(name, z, self._width, self._height)
+        self._layers[name] = layer
+        self._stack_dirty = True
+        return layer
+
+    def get_layer(self, name: str) -> Optional[Layer]:
+        return self._layers.get(name)
+
+    def remove_layer(self, name: str):
+        if self._layers.pop(name, None) is not None:
+            self._premultiplied.pop(name, None)
+            self._stack_dirty = True
+
+    def get_layers(self) -> List[Layer]:
+        return sorted(self._layers.values(), key=lambda layer: layer.z)
+
+    @property
+    def dirty(self) -> bool:
+        return self._stack_dirty or any(layer.dirty for layer in self._layers.values())
+
+    def _update_stack(self):
+        if not self.dirty:
+            return
+        color = np.zeros((self._height, self._width, 3), dtype=np.float32)
+        transmittance = np.ones((self._height, self._width, 1), dtype=np.float32)
+        for layer in self.get_layers():
+            if layer.dirty or layer.name not in self._premultiplied:
+                alpha = layer.rgba[..., 3:].astype(np.float32) / 255
+                self._premultiplied[layer.name] = (layer.rgba[..., :3] * alpha, alpha)
+                layer.mark_clean()
+            if not layer.visible:
+                continue
+            layer_color, alpha = self._premultiplied[layer.name]
+            color *= 1 - alpha
+            color += layer_color
+            transmittance *= 1 - alpha
+        self._stack_dirty = False
+        covered = np.flatnonzero(transmittance.reshape(-1) < 1)
+        if not len(covered):
+            self._covered = None
+            return
+        self._covered = covered
+        self._color = color.reshape(-1, 3)[covered]
+        self._transmittance = transmittance.reshape(-1, 1)[covered]
+
+    def compose(self, base: np.ndarray) -> np.ndarray:
+        """ Returns base with the overlays blended on top, base itself when no overlay covers anything """
+        self._update_stack()
+        if self._covered is None:
+            return base
+        out = self._out
+        out[...] = base
+        flat = out.reshape(-1, 3)
+        blended = flat[self._covered] * self._transmittance + self._color
+        flat[self._covered] = np.rint(blended).astype(np.uint8)
+        return out
@@ -1,5 +1,12 @@
+import math
+import asyncio
 import logging
+import numpy as np
 from pathlib import Path
+from typing import Callable, List, Optional
+from PIL import Image
+from importlib import resources
+from configparser import ConfigParser
 
 
 try:
@@ -16,26 +23,53 @@ except ImportError:
             self.brightness = 40
             self.gpio_slowdown = 0
 
-    class RGBMatrix:
-        def __init__(self, options):
+    class FrameCanvas:
+        def __init__(self, width=64, height=64):
+            self.width = width
+            self.height = height
             self.brightness = 40
         def SetPixel(self, x, y, r, g, b):
             pass
         def Clear(self):
             pass
-        def SetImage(self, image, unsafe):
+        def Fill(self, r, g, b):
+            pass
+        def SetImage(self, image, offset_x=0, offset_y=0, unsafe=True):
             pass
 
+    class RGBMatrix(FrameCanvas):
+        def __init__(self, options):
+            super().__init__(options.cols, options.rows)
+            self._active = self
+        def CreateFrameCanvas(self):
+            return FrameCanvas(self.width, self.height)
+        def SwapOnVSync(self, canvas, framerate_fraction=1):
+            previous, self._active = self._active, canvas
+            return previous
+
 
 from home_led_matrix.utils import SingletonMeta
+from home_led_matrix.metrics import Metrics
+from home_led_matrix.display.compositor import Compositor, Layer
 
 log = logging.getLogger(Path(__file__).stem)
 
+metrics = Metrics()
+
+conf = ConfigParser()
+
+with open(resources.files('home_led_matrix').joinpath('config.ini')) as f:
+    conf.read_file(f)
+
+
 class DisplayHandler(metaclass=SingletonMeta):
-    def __init__(self) -> None:
+    def __init__(self,
+            double_buffer=conf["DISPLAY"].getboolean("double_buffer", True),
+            tile_size=conf["DISPLAY"].getint("tile_size", 16),
+            max_regions=conf["DISPLAY"].getint("max_regions", 8)) -> None:
         options = RGBMatrixOptions()
-        options.rows = 64
-        options.cols = 64
+        options.rows = conf["DISPLAY"].getint("height", 64)
+        options.cols = conf["DISPLAY"].getint("width", 64)
         options.brightness = 40
         options.gpio_slowdown = 1
         options.chain_length = 1
@@ -43,23 +77,178 @@ class DisplayHandler(metaclass=SingletonMeta):
         options.hardware_mapping = 'regular'
         options.drop_privileges = False
         self._matrix = RGBMatrix(options = options)
+        self._width = options.cols
+        self._height = options.rows
+        # Everything is drawn into this framebuffer and pushed to the panel in one call by show()
+        self._frame = np.zeros((self._height, self._width, 3), dtype=np.uint8)
+        # In double buffered mode frames are drawn to an off-screen canvas which is swapped in on vsync,
+        # so the panel never shows a half drawn frame
+        self._double_buffer = double_buffer
+        self._canvas = self._matrix.CreateFrameCanvas() if double_buffer else None
+        # What is currently on the panel, and what the off-screen canvas holds (two frames back when double buffered)
+        self._displayed = np.zeros_like(self._frame)
+        self._canvas_frame = np.zeros_like(self._frame) if double_buffer else self._displayed
+        if tile_size <= 0 or self._height % tile_size or self._width % tile_size:
+            # the largest tile that divides both sides, one tile per frame on a square panel
+            log.warning(f"Tile size {tile_size} does not divide the {self._width}x{self._height} panel")
+            tile_size = math.gcd(self._height, self._width)
+        self._tile_size = tile_size
+        self._max_regions = max_regions
+        self._full_pushes_pending = 0
+        self._changed_pixels = 0
+        # Overlays shared between apps and the system, blended over the app frame in show()
+        self._compositor = Compositor(self._width, self._height)
+        self._frame_waiters: List[asyncio.Future] = []
+        # Applied to the composited frame in show(), used for transitions
+        self._frame_filter: Optional[Callable[[np.ndarray], np.ndarray]] = None
+        # The app that has the panel, writes passing another owner are dropped. None lets everyone write
+        self._owner: Optional[object] = None
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def changed_pixels(self) -> int:
+        """ Number of pixels that changed on the panel with the last call to show() """
+        return self._changed_pixels
 
-    def set_pixels(self, pixels):
-        for (x, y), color in pixels:
-            self._matrix.SetPixel(x, y, *color)
+    def set_owner(self, owner: Optional[object]):
+        """ Gives the panel to owner, writes by anyone else that pass an owner are dropped from now on """
+        self._owner = owner
+
+    def is_owner(self, owner: Optional[object]) -> bool:
+        return owner is None or self._owner is None or owner is self._owner
+
+    def set_pixels(self, xs: np.ndarray, ys: np.ndarray, colors: np.ndarray, owner: Optional[object] = None):
+        """ Scatter write, xs and ys are arrays of length N and colors is an (N, 3) array """
+        if self.is_owner(owner):
+            self._frame[ys, xs] = colors
 
     def set_pixel(self, x, y, color):
-        self._matrix.SetPixel(x, y, *color)
+        self._frame[y, x] = color
+
+    def set_frame(self, frame: np.ndarray, owner: Optional[object] = None):
+        if self.is_owner(owner):
+            self._frame[...] = frame
+
+    def get_frame(self) -> np.ndarray:
+        return self._frame.copy()
+
+    def add_layer(self, name: str, z: int = 1) -> Layer:
+        """ Adds an RGBA overlay above the app frame, call show() after drawing to it """
+        return self._compositor.add_layer(name, z)
+
+    def get_layer(self, name: str) -> Optional[Layer]:
+        return self._compositor.get_layer(name)
+
+    def remove_layer(self, name: str):
+        self._compositor.remove_layer(name)
+
+    def get_composited_frame(self) -> np.ndarray:
+        """ The app frame with the overlays on top, as it is pushed to the panel """
+        return self._compositor.compose(self._frame).copy()
+
+    def set_frame_filter(self, frame_filter: Optional[Callable[[np.ndarray], np.ndarray]]):
+        """ frame_filter gets the composited frame and returns the frame to push, it must not modify its argument """
+        self._frame_filter = frame_filter
+
+    def get_displayed_frame(self) -> np.ndarray:
+        """ What is currently on the panel """
+        return self._displayed.copy()
+
+    async def wait_frame(self, timeout: Optional[float] = None) -> bool:
+        """ Waits until the next call to show() has finished, returns False on timeout """
+        waiter = asyncio.get_running_loop().create_future()
+        self._frame_waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self._frame_waiters:
+                self._frame_waiters.remove(waiter)
+
+    def _frame_done(self):
+        waiters, self._frame_waiters = self._frame_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def invalidate(self):
+        """ Force the next frame to be pushed in full, to every canvas """
+        self._full_pushes_pending = 2 if self._double_buffer else 1
+
+    def _dirty_regions(self, mask: np.ndarray):
+        """ Returns the dirty tiles of the mask as (x0, y0, x1, y1) rectangles, horizontal runs of tiles are merged """
+        ts = self._tile_size
+        tiles = mask.reshape(self._height // ts, ts, self._width // ts, ts).any(axis=(1, 3))
+        regions = []
+        for ty, row in enumerate(tiles):
+            padded = np.concatenate(([False], row, [False]))
+            edges = np.flatnonzero(padded[1:] != padded[:-1])
+            for start, end in zip(edges[::2], edges[1::2]):
+                regions.append((int(start) * ts, ty * ts, int(end) * ts, (ty + 1) * ts))
+        return regions
+
+    def show(self, owner: Optional[object] = None) -> int:
+        """ Push the framebuffer to the panel, only the tiles that differ from what the canvas holds are sent.
+        Returns the number of pixels that changed on the panel """
+        if not self.is_owner(owner):
+            return 0
+        frame = self._compositor.compose(self._frame)
+        if self._frame_filter is not None:
+            frame = self._frame_filter(frame)
+        self._changed_pixels = int(np.count_nonzero((frame != self._displayed).any(axis=2)))
+        if self._full_pushes_pending:
+            self._full_pushes_pending -= 1
+            regions = [(0, 0, self._width, self._height)]
+        elif self._changed_pixels == 0:
+            self._frame_done()
+            return 0
+        else:
+            regions = self._dirty_regions((frame != self._canvas_frame).any(axis=2))
+            if len(regions) > self._max_regions:
+                regions = [(0, 0, self._width, self._height)]
+        target = self._canvas if self._double_buffer else self._matrix
+        with metrics.timer("display.push_ms"):
+            for x0, y0, x1, y1 in regions:
+                # unsafe=True lets the bindings copy the RGB buffer directly instead of going through getpixel
+                region = np.ascontiguousarray(frame[y0:y1, x0:x1])
+                target.SetImage(Image.fromarray(region, "RGB"), x0, y0, unsafe=True)
+            self._canvas_frame[...] = frame
+            if self._double_buffer:
+                self._canvas = self._matrix.SwapOnVSync(self._canvas)
+                self._displayed, self._canvas_frame = self._canvas_frame, self._displayed
+        metrics.observe("display.changed_pixels", self._changed_pixels)
+        metrics.observe("display.regions", len(regions))
+        self._frame_done()
+        return self._changed_pixels
 
-    def clear(self):
-        self._matrix.Clear()
+    def clear(self, owner: Optional[object] = None):
+        if self.is_owner(owner):
+            self._frame.fill(0)
+            self.show(owner)
 
-    def set_image(self, image):
-        self._matrix.SetImage(image, unsafe=False)
+    def set_image(self, image: Image.Image):
+        image = image.convert("RGB")
+        if image.size != (self._width, self._height):
+            image = image.resize((self._width, self._height))
+        self.set_frame(np.asarray(image))
+        self.show()
 
     def set_brightness(self, value):
         try:
             self._matrix.brightness = int(value)
+            if self._canvas is not None:
+                self._canvas.brightness = int(value)
+            # Brightness is applied when pixels are written, so everything has to be pushed again
+            self.invalidate()
         except Exception as e:
             log.error(e)
 
@@ -12,6 +12,9 @@ from home_led_matrix.connection import ConnServer
 from home_led_matrix.apps.snake_app.snake_app import SnakeApp
 from home_led_matrix.apps.pixelart_app.pixelart_app import PixelArtApp
 from home_led_matrix.apps.app_handler import AppHandler
+from home_led_matrix.apps.transitions import TransitionEngine
+from home_led_matrix.utils import HttpClient, ConfigPersist
+from home_led_matrix.metrics import Metrics
 
 conf = ConfigParser()
 
@@ -28,8 +31,15 @@ DEFAULT_PUB_PORT = conf["CONNECTION"]["pub_port"]
 # SNAKE APP
 DEFAULT_HOST = conf["SNAKE_APP"]["host"]
 DEFAULT_PORT = conf["SNAKE_APP"]["port"]
+DEFAULT_RUN_CACHE_DIR = conf["SNAKE_APP"]["run_cache_dir"]
+DEFAULT_RUN_CACHE_SIZE_MB = conf["SNAKE_APP"]["run_cache_size_mb"]
 # PIXEL APP
 DEFAULT_IMAGE_DIR = conf["PIXELART_APP"]["image_dir"]
+DEFAULT_FRAME_CACHE_MB = conf["PIXELART_APP"]["frame_cache_mb"]
+DEFAULT_ATLAS_DIR = conf["PIXELART_APP"]["atlas_dir"]
+DEFAULT_ATLAS_SIZE_MB = conf["PIXELART_APP"]["atlas_size_mb"]
+# METRICS
+DEFAULT_METRICS_INTERVAL = conf["METRICS"]["publish_interval"]
 
 # Global singletons
 display_handler = DisplayHandler()
@@ -51,14 +61,20 @@ def cli(args):
     snake_app = p.add_argument_group("Snake app")
     snake_app.add_argument("--host", default=DEFAULT_HOST, help=f"Host, default: {DEFAULT_HOST}")
     snake_app.add_argument("--port", default=DEFAULT_PORT, help=f"Port, default: {DEFAULT_PORT}")
+    snake_app.add_argument("--run-cache-dir", default=DEFAULT_RUN_CACHE_DIR, help=f"Directory for cached runs, empty to disable, default: {DEFAULT_RUN_CACHE_DIR}")
+    snake_app.add_argument("--run-cache-size-mb", default=DEFAULT_RUN_CACHE_SIZE_MB, help=f"Max size of the run cache, default: {DEFAULT_RUN_CACHE_SIZE_MB}")
 
     pixel_app = p.add_argument_group("Pixel Art app")
     pixel_app.add_argument("--image-dir", default=DEFAULT_IMAGE_DIR, help=f"Image directory, default: {DEFAULT_IMAGE_DIR}")
+    pixel_app.add_argument("--frame-cache-mb", default=DEFAULT_FRAME_CACHE_MB, help=f"Memory budget for decoded frames, default: {DEFAULT_FRAME_CACHE_MB}")
+    pixel_app.add_argument("--atlas-dir", default=DEFAULT_ATLAS_DIR, help=f"Directory for decoded frames on disk, empty to disable, default: {DEFAULT_ATLAS_DIR}")
+    pixel_app.add_argument("--atlas-size-mb", default=DEFAULT_ATLAS_SIZE_MB, help=f"Max size of the frame atlas, default: {DEFAULT_ATLAS_SIZE_MB}")
 
     conn = p.add_argument_group("Connection")
     conn.add_argument("--ctl-host", default=DEFAULT_CONN_HOST, help=f"Socket file, default: {DEFAULT_CONN_HOST}")
     conn.add_argument("--route-port", default=DEFAULT_ROUTE_PORT, help=f"Route port, default: {DEFAULT_ROUTE_PORT}")
     conn.add_argument("--pub-port", default=DEFAULT_PUB_PORT, help=f"Publish port, default: {DEFAULT_PUB_PORT}")
+    conn.add_argument("--metrics-interval", type=float, default=DEFAULT_METRICS_INTERVAL, help=f"Seconds between metrics updates on the publish port, 0 disables them, default: {DEFAULT_METRICS_INTERVAL}")
 
     logging = p.add_argument_group("Logging")
     logging.add_argument("--log-level", default=DEFAULT_LOG_LEVEL, help=f"Log level, default: {DEFAULT_LOG_LEVEL}")
@@ -67,13 +83,24 @@ def cli(args):
     return p.parse_args(args)
 
 
+async def publish_metrics(conn_server: ConnServer, interval: float):
+    metrics = Metrics()
+    while True:
+        await asyncio.sleep(interval)
+        conn_server.publish({"metrics": metrics.summary()})
+
+
 async def main(args):
+    metrics_task = None
     try:
         msg_handler = MessageHandler()
         conn_server = ConnServer(args.route_port, args.pub_port, args.ctl_host)
         conn_server.set_message_handler(msg_handler)
-        snake_app = SnakeApp(args.host, args.port)
-        pixelart_app = PixelArtApp(args.image_dir)
+        msg_handler.add_handlers("queue_depth", getter=conn_server.get_queue_depths)
+        msg_handler.add_handlers("metrics", getter=Metrics().get_metrics)
+        msg_handler.add_handlers("metrics_reset", action=Metrics().reset)
+        snake_app = SnakeApp(args.host, args.port, args.run_cache_dir, args.run_cache_size_mb)
+        pixelart_app = PixelArtApp(args.image_dir, args.frame_cache_mb, args.atlas_dir, args.atlas_size_mb)
         app_handler = AppHandler()
 
         app_handler.add_app("snakes", snake_app)
@@ -84,27 +111,54 @@ async def main(args):
         msg_handler.add_handlers("apps", getter=app_handler.get_apps)
         msg_handler.add_handlers("brightness", app_handler.set_brightness, app_handler.get_brightness)
         msg_handler.add_handlers("display_on", app_handler.display_on, app_handler.get_display_on)
+        msg_handler.add_handlers("changed_pixels", getter=app_handler.get_changed_pixels)
+        transitions = TransitionEngine()
+        msg_handler.add_handlers("transition", transitions.set_transition, transitions.get_transition)
+        msg_handler.add_handlers("transitions", getter=transitions.get_transitions)
+        msg_handler.add_handlers("transition_duration", transitions.set_duration, transitions.get_duration)
 
         # Snake app message handlers
         msg_handler.add_handlers('food', snake_app.set_food, snake_app.get_food)
         msg_handler.add_handlers('food_decay', snake_app.set_food_decay, snake_app.get_food_decay)
         msg_handler.add_handlers('snakes_fps', snake_app.set_fps, snake_app.get_fps)
+        msg_handler.add_handlers('snakes_frame_stats', getter=snake_app.get_frame_stats)
         msg_handler.add_handlers('snake_map', snake_app.set_map, snake_app.get_map)
         msg_handler.add_handlers('snake_maps', getter=snake_app.get_maps)
         msg_handler.add_handlers('restart_snakes', action=snake_app.restart)
+        msg_handler.add_handlers('snake_cached_runs', getter=snake_app.get_cached_runs)
+        msg_handler.add_handlers('snake_replay', setter=snake_app.replay)
+        msg_handler.add_handlers('snake_seek', snake_app.seek, snake_app.get_seek)
         msg_handler.add_handlers('food_decay', snake_app.set_food_decay, snake_app.get_food_decay)
         msg_handler.add_handlers('nr_snakes', snake_app.set_nr_snakes, snake_app.get_nr_snakes)
 
         # Pixel Art app message handlers
-
+        msg_handler.add_handlers('pixelart_image', pixelart_app.set_image, pixelart_app.get_image)
+        msg_handler.add_handlers('pixelart_images', getter=pixelart_app.get_images)
+        msg_handler.add_handlers('pixelart_image_index', getter=pixelart_app.get_image_index)
+        msg_handler.add_handlers('pixelart_image_info', getter=pixelart_app.get_image_info)
+        msg_handler.add_handlers('pixelart_next', action=pixelart_app.next_image)
+        msg_handler.add_handlers('pixelart_slideshow', pixelart_app.set_slideshow, pixelart_app.get_slideshow)
+        msg_handler.add_handlers('pixelart_slide_duration', pixelart_app.set_slide_duration, pixelart_app.get_slide_duration)
+        msg_handler.add_handlers('pixelart_playlist', pixelart_app.set_playlist, pixelart_app.get_playlist)
+        msg_handler.add_handlers('pixelart_cache_stats', getter=pixelart_app.get_cache_stats)
+
+        # the first scan of the image directory runs in the background from the start
+        pixelart_app.start_index()
         await app_handler.switch_app("snakes")
+        if args.metrics_interval > 0:
+            metrics_task = asyncio.create_task(publish_metrics(conn_server, args.metrics_interval))
         await conn_server.start()
     finally:
+        if metrics_task is not None:
+            metrics_task.cancel()
         display_handler.clear()
         try:
             await app_handler.shutdown()
+            await pixelart_app.close()
         except Exception as e:
             log.error(e)
+        await HttpClient().close()
+        ConfigPersist.flush_all()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,37 @@
+import asyncio
 import logging
 import json
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from home_led_matrix.utils import AsyncTTLCache
+
 from abc import ABC, abstractmethod
-from typing import Optional, Callable, List, Dict, Any
+from typing import Optional, Callable, List, Dict, Any, AsyncIterator, Tuple
 from pathlib import Path
 
 log = logging.getLogger(Path(__file__).stem)
 
+# Wire encodings, the encoding of a message is detected from its first byte:
+# a JSON object starts with '{' (or whitespace), a msgpack map never does
+JSON = "json"
+MSGPACK = "msgpack"
+
+_JSON_FIRST_BYTES = b"{ \t\r\n"
+
+
+def resolve_encoding(encoding: str) -> str:
+    """ Checks a configured encoding, msgpack falls back to JSON when it is not installed """
+    if encoding not in (JSON, MSGPACK):
+        raise ValueError(f"Unknown encoding: {encoding}, must be {JSON} or {MSGPACK}")
+    if encoding == MSGPACK and msgpack is None:
+        log.warning("msgpack is not installed, falling back to json")
+        return JSON
+    return encoding
+
 
 class Message:
 
@@ -16,14 +41,37 @@ class Message:
     @classmethod
     def from_json(cls, json_str: str):
         instance = cls()
-        instance.__dict__ = json.loads(json_str)
+        instance.__dict__.update(json.loads(json_str))
         return instance
 
     def to_json(self) -> str:
-        return json.dumps(self.__dict__, indent=2, ensure_ascii=False)  # Pretty format
+        return json.dumps(self.__dict__, separators=(",", ":"), ensure_ascii=False)
+
+    @classmethod
+    def from_msgpack(cls, data: bytes):
+        instance = cls()
+        instance.__dict__.update(msgpack.unpackb(data, raw=False))
+        return instance
+
+    def to_msgpack(self) -> bytes:
+        return msgpack.packb(self.__dict__, use_bin_type=True)
+
+    @classmethod
+    def decode(cls, data: bytes) -> Tuple["Message", str]:
+        """ Returns the message and the encoding it was sent with """
+        if data[:1] and data[:1] not in _JSON_FIRST_BYTES:
+            if msgpack is None:
+                raise ValueError("Received a msgpack message but msgpack is not installed")
+            return cls.from_msgpack(data), MSGPACK
+        return cls.from_json(data.decode()), JSON
+
+    def encode(self, encoding: str = JSON) -> bytes:
+        if encoding == MSGPACK:
+            return self.to_msgpack()
+        return self.to_json().encode()
 
     def __str__(self):
-        return self.to_json()
+        return json.dumps(self.__dict__, indent=2, ensure_ascii=False)  # Pretty format
 
     def __repr__(self):
         return f"<{self.__class__.__name__} {self.__str__()}>"
@@ -37,6 +85,10 @@ class Request(Message):
         self.gets = []
         self.sets = {}
         self.actions = []
+        # Ask for a partial response per get as soon as it is ready, before the final response
+        self.partial = False
+        # Set by clients that pipeline requests, echoed in every response to the request
+        self.id = None
 
     def get(self, key):
         self.gets.append(key)
@@ -57,6 +109,11 @@ class Response(Message):
         self.sets = {}
         self.actions = {}
         self.errors = {}
+        # True for the early responses to a partial request, the last response is always False
+        self.partial = False
+        self.id = None
+        # True if the server rejected the request without handling it, its client queue was full
+        self.busy = False
 
     def get(self, key, value):
         self.gets[key] = value
@@ -92,53 +149,101 @@ class IMessageHandler(ABC):
     async def handle_msg(self, message: Request) -> Response:
         pass
 
+    @abstractmethod
+    def handle_msg_partial(self, message: Request) -> AsyncIterator[Response]:
+        pass
+
     @abstractmethod
     def add_handlers(
             self,
             message_key: str,
             setter: Optional[Callable]=None,
             getter: Optional[Callable]=None,
-            action: Optional[Callable]=None):
+            action: Optional[Callable]=None,
+            cache_ttl: Optional[float]=None,
+            timeout: Optional[float]=None):
         pass
 
 
 class MessageHandler:
-    def __init__(self):
+    def __init__(self, get_timeout: float = 5):
         self._get_handlers = {}
         self._set_handlers = {}
         self._action_handlers = {}
+        self._get_cache = AsyncTTLCache()
+        self._cache_ttls: Dict[str, float] = {}
+        self._get_timeout = get_timeout
+        self._get_timeouts: Dict[str, float] = {}
 
     def add_handlers(
             self,
             message_key: str,
             setter: Optional[Callable]=None,
             getter: Optional[Callable]=None,
-            action: Optional[Callable]=None):
-
+            action: Optional[Callable]=None,
+            cache_ttl: Optional[float]=None,
+            timeout: Optional[float]=None):
+        """ With cache_ttl the getter result is cached for that many seconds, a set of the same key invalidates it.
+        timeout overrides how long the getter may take before it is reported as an error """
         if setter is not None:
             self._set_handlers[message_key] = setter
         if getter is not None:
             self._get_handlers[message_key] = getter
+            if cache_ttl is not None:
+                self._cache_ttls[message_key] = cache_ttl
+            if timeout is not None:
+                self._get_timeouts[message_key] = timeout
         if action is not None:
             self._action_handlers[message_key] = action
 
+    def invalidate(self, message_key: Optional[str]=None):
+        """ Drop the cached value of a getter, or of every getter if message_key is None """
+        self._get_cache.invalidate(message_key)
+
     async def handle_msg(self, message: Request) -> Response:
         response = Response()
-        if "all" in message.gets:
-            await self._handle_gets(self._get_handlers.keys(), response)
-        else:
-            await self._handle_gets(message.gets, response)
+        await self._handle_gets(self._get_keys(message), response)
         await self._handle_sets(message.sets, response)
         await self._handle_actions(message.actions, response)
         return response
 
+    async def handle_msg_partial(self, message: Request) -> AsyncIterator[Response]:
+        """ Yields a partial response per get as soon as it is done, then a final response with the sets and actions """
+        for next_get in asyncio.as_completed([self._keyed_get(key) for key in self._get_keys(message)]):
+            response = Response()
+            response.partial = True
+            self._add_get_result(response, *await next_get)
+            yield response
+        response = Response()
+        await self._handle_sets(message.sets, response)
+        await self._handle_actions(message.actions, response)
+        yield response
+
+    def _get_keys(self, message: Request) -> List[str]:
+        if "all" in message.gets:
+            return list(self._get_handlers.keys())
+        return list(dict.fromkeys(message.gets))
+
+    async def _keyed_get(self, key):
+        """ Returns (key, value or exception), getters run concurrently and each one is bound by its timeout """
+        try:
+            return key, await asyncio.wait_for(self._get(key), self._get_timeouts.get(key, self._get_timeout))
+        except asyncio.TimeoutError:
+            log.error(f"Getter for {key} timed out")
+            return key, TimeoutError(f"Timed out getting {key}")
+        except Exception as e:
+            return key, e
+
+    def _add_get_result(self, response: Response, key, result):
+        if isinstance(result, Exception):
+            response.error(key, "get", str(result))
+        else:
+            response.get(key, result)
+
     async def _handle_gets(self, get_list: List[str], response: Response):
-        for get in get_list:
-            try:
-                get_value = await self._get(get)
-                response.get(get, get_value)
-            except Exception as e:
-                response.error(get, "get", str(e))
+        results = await asyncio.gather(*(self._keyed_get(key) for key in get_list))
+        for key, result in results:
+            self._add_get_result(response, key, result)
 
     async def _handle_sets(self, set_dict: Dict[str, Any], response: Response):
         for key, value in set_dict.items():
@@ -173,10 +278,15 @@ class MessageHandler:
 
     async def _set(self, key, value):
         handler = self._get_handler(self._set_handlers, key)
-        await self._call_handler(handler, value)
+        try:
+            await self._call_handler(handler, value)
+        finally:
+            self._get_cache.invalidate(key)
 
     async def _get(self, key):
         handler = self._get_handler(self._get_handlers, key)
+        if key in self._cache_ttls:
+            return await self._get_cache.get(key, lambda: self._call_handler(handler), self._cache_ttls[key])
         return await self._call_handler(handler)
 
     async def _action(self, action):
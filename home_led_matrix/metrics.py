@@ -0,0 +1,88 @@
+import time
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Dict
+
+from home_led_matrix.utils import SingletonMeta
+
+log = logging.getLogger(Path(__file__).stem)
+
+PERCENTILES = (50, 90, 99)
+
+
+class RollingStats:
+    """ The last window values in a ring buffer, adding a value is O(1), percentiles are computed when asked for """
+
+    def __init__(self, window: int = 512):
+        self._values = np.zeros(window, dtype=np.float64)
+        self._index = 0
+        self._count = 0
+
+    def add(self, value: float):
+        self._values[self._index] = value
+        self._index = (self._index + 1) % len(self._values)
+        self._count += 1
+
+    def reset(self):
+        self._index = 0
+        self._count = 0
+
+    def summary(self) -> dict:
+        """ count is the total since the last reset, the rest is over the window """
+        values = self._values[:min(self._count, len(self._values))]
+        if not len(values):
+            return {"count": 0}
+        summary = {"count": self._count, "mean": round(float(values.mean()), 3)}
+        for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+            summary[f"p{percentile}"] = round(float(value), 3)
+        summary["max"] = round(float(values.max()), 3)
+        return summary
+
+
+class Timer:
+    """ Context manager that adds the time spent in it to a RollingStats, in milliseconds """
+
+    __slots__ = ("_stats", "_start")
+
+    def __init__(self, stats: RollingStats):
+        self._stats = stats
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._stats.add((time.perf_counter() - self._start) * 1000)
+        return False
+
+
+class Metrics(metaclass=SingletonMeta):
+    """ Rolling stats by name. Timings are named *_ms and in milliseconds """
+
+    def __init__(self, window: int = 512):
+        self._window = window
+        self._stats: Dict[str, RollingStats] = {}
+
+    def _get(self, name: str) -> RollingStats:
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = RollingStats(self._window)
+        return stats
+
+    def observe(self, name: str, value: float):
+        self._get(name).add(value)
+
+    def timer(self, name: str) -> Timer:
+        return Timer(self._get(name))
+
+    def summary(self) -> Dict[str, dict]:
+        return {name: stats.summary() for name, stats in sorted(self._stats.items())}
+
+    async def get_metrics(self) -> Dict[str, dict]:
+        return self.summary()
+
+    async def reset(self):
+        for stats in self._stats.values():
+            stats.reset()
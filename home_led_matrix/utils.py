@@ -1,8 +1,15 @@
+import os
 import json
+import time
+import weakref
+import threading
+import random
+import asyncio
 import logging
 import aiohttp
 
 from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
 
 log = logging.getLogger(Path(__file__).stem)
 
@@ -31,17 +38,91 @@ class DotDict(dict):
 
 
 class ConfigPersist(DotDict):
-    def __init__(self, name: str, file_path: Path = None):
+    """ Changes made with set() are written behind: at most one write per flush_delay seconds,
+    done in an executor, and atomic (temp file, fsync, rename). Call flush_all() on shutdown. """
+
+    _all = []
+
+    def __init__(self, name: str, file_path: Path = None, flush_delay: float = 2.0):
         super().__init__()
         self._name = name
         self._file_path = str(file_path or Path(Path.home(), ".config", f"{self._name}.json"))
+        # internal state is kept out of the dict, so it is not persisted
+        object.__setattr__(self, "_flush_delay", flush_delay)
+        object.__setattr__(self, "_flush_handle", None)
+        object.__setattr__(self, "_write_lock", threading.Lock())
+        object.__setattr__(self, "_version", 0)
+        object.__setattr__(self, "_written_version", 0)
+        ConfigPersist._all.append(weakref.ref(self))
         self.load()
 
+    def _snapshot(self):
+        object.__setattr__(self, "_version", self._version + 1)
+        return self._version, json.dumps(self)
+
+    def _write(self, version: int, data: str):
+        with self._write_lock:
+            # an older snapshot can get here after a newer one when several writes are in flight
+            if version <= self._written_version:
+                return
+            path = Path(self._file_path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.tmp")
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            dir_fd = os.open(path.parent, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            object.__setattr__(self, "_written_version", version)
+
+    def _cancel_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            object.__setattr__(self, "_flush_handle", None)
+
+    def _flush_in_executor(self, loop: asyncio.AbstractEventLoop):
+        object.__setattr__(self, "_flush_handle", None)
+        future = loop.run_in_executor(None, self._write, *self._snapshot())
+        future.add_done_callback(self._log_write_error)
+
+    def _log_write_error(self, future: asyncio.Future):
+        # exception() raises on a cancelled future, the write is cancelled when the loop shuts down
+        if not future.cancelled() and future.exception() is not None:
+            log.error(f"Failed to save {self._name}: {future.exception()}")
+
     def save(self):
-        if not Path(self._file_path).parent.exists():
-            Path(self._file_path).parent.mkdir(parents=True)
-        with open(Path(self._file_path), 'w') as f:
-            json.dump(self, f)
+        """ Write now, blocking """
+        self._cancel_flush()
+        self._write(*self._snapshot())
+
+    def save_later(self):
+        """ Schedule a write, changes made before it runs are written together """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        if self._flush_handle is None:
+            object.__setattr__(self, "_flush_handle", loop.call_later(self._flush_delay, self._flush_in_executor, loop))
+
+    def flush(self):
+        """ Write a scheduled change now, blocking """
+        if self._flush_handle is not None:
+            self.save()
+
+    @classmethod
+    def flush_all(cls):
+        for ref in cls._all:
+            if (config := ref()) is not None:
+                try:
+                    config.flush()
+                except Exception as e:
+                    log.error(e)
 
     def load(self):
         if Path(self._file_path).exists():
@@ -51,7 +132,7 @@ class ConfigPersist(DotDict):
     
     def set(self, key, value):
         self[key] = value
-        self.save()
+        self.save_later()
 
 
 class SingletonMeta(type):
@@ -63,6 +144,58 @@ class SingletonMeta(type):
         return cls._instances[cls]
 
 
+class AsyncTTLCache:
+    """ Memoizes async fetches per key for ttl seconds.
+
+    Concurrent gets of a key that is not cached share one fetch. None results are not cached. """
+
+    def __init__(self, ttl: float = 60):
+        self._ttl = ttl
+        self._values: Dict[Hashable, Tuple[float, Any]] = {}
+        # fetches in flight per key, with the generation of the key they were started in
+        self._in_flight: Dict[Hashable, Tuple[int, asyncio.Future]] = {}
+        # bumped by invalidate, a fetch started before that is neither stored nor joined
+        self._generations: Dict[Hashable, int] = {}
+        self._generation = 0
+
+    def _get_generation(self, key: Hashable) -> Tuple[int, int]:
+        return self._generation, self._generations.get(key, 0)
+
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], ttl: float = None):
+        entry = self._values.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        generation = self._get_generation(key)
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None and in_flight[0] == generation:
+            future = in_flight[1]
+        else:
+            future = asyncio.ensure_future(self._fetch(key, fetch, self._ttl if ttl is None else ttl, generation))
+            self._in_flight[key] = (generation, future)
+        # shielded so one caller being cancelled does not cancel the fetch for the others
+        return await asyncio.shield(future)
+
+    async def _fetch(self, key, fetch, ttl, generation):
+        try:
+            value = await fetch()
+            if value is not None and self._get_generation(key) == generation:
+                self._values[key] = (time.monotonic() + ttl, value)
+            return value
+        finally:
+            in_flight = self._in_flight.get(key)
+            if in_flight is not None and in_flight[0] == generation:
+                del self._in_flight[key]
+
+    def invalidate(self, key: Hashable = None):
+        """ Drop one key, or everything if key is None. Fetches already in flight are not cached """
+        if key is None:
+            self._values.clear()
+            self._generation += 1
+        else:
+            self._values.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+
 def convert_arg(type):
     def decorator(func):
         async def wrapper(self, value):
@@ -75,29 +208,70 @@ def convert_arg(type):
     return decorator
 
 
-async def async_get_request(uri):
-    log.debug(f"GET request to {uri}")
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(uri) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                else:
-                    log.error(f"Server returned: {resp.status}")
-                    log.debug(await resp.text())
-    except Exception as e:
-        log.error(e)
-
-
-async def async_post_request(uri, data):
-    log.debug(f"POST request to {uri}")
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(uri, json=data) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                else:
+def to_bool(value) -> bool:
+    if isinstance(value, str):
+        if value.strip().lower() in ("1", "true", "yes", "on"):
+            return True
+        if value.strip().lower() in ("0", "false", "no", "off", ""):
+            return False
+        raise ValueError(f"Not a boolean: {value}")
+    return bool(value)
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """ Exponential backoff with full jitter, attempt starts at 0 """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class HttpClient(metaclass=SingletonMeta):
+    """ One pooled keep-alive aiohttp session shared by every request, close it on shutdown """
+
+    def __init__(self, timeout: float = 10, connection_limit: int = 8, dns_cache_ttl: int = 300):
+        self._timeout = timeout
+        self._connection_limit = connection_limit
+        self._dns_cache_ttl = dns_cache_ttl
+        self._session: aiohttp.ClientSession = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # created lazily, a session has to be created inside the running loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._connection_limit, ttl_dns_cache=self._dns_cache_ttl)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self._timeout))
+        return self._session
+
+    async def request(self, method, uri, data=None, timeout: float = None, retries: int = 0, backoff: float = 0.5, max_backoff: float = 30):
+        """ Returns the json body of a 200 response, None if every attempt failed.
+        Connection errors, timeouts and 5xx responses are retried with jittered exponential backoff """
+        # timeout=None would turn off the session timeout, so it is only passed when given
+        kwargs = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout is not None else {}
+        for attempt in range(retries + 1):
+            log.debug(f"{method} request to {uri}, attempt {attempt + 1}")
+            try:
+                async with self._get_session().request(method, uri, json=data, **kwargs) as resp:
+                    if resp.status == 200:
+                        return await resp.json()
                     log.error(f"Server returned: {resp.status}")
                     log.debug(await resp.text())
-    except Exception as e:
-        log.error(e)
\ No newline at end of file
+                    if resp.status < 500:
+                        return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.error(f"{method} {uri} failed: {e}")
+            except Exception as e:
+                log.error(e)
+                return None
+            if attempt < retries:
+                await asyncio.sleep(backoff_delay(attempt, backoff, max_backoff))
+        return None
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+async def async_get_request(uri, **kwargs):
+    return await HttpClient().request("GET", uri, **kwargs)
+
+
+async def async_post_request(uri, data, **kwargs):
+    return await HttpClient().request("POST", uri, data, **kwargs)
\ No newline at end of file